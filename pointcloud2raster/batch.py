@@ -0,0 +1,207 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import multiprocessing
+from loghelper import Logger
+from raster import Raster
+from pointcloud2raster import GridRaster, AddGriddingArguments, GriddingArguments
+
+# Per-process state for the pool workers. Set once by _initBatchWorker
+_worker = {}
+
+
+def ReadManifest(manifest):
+    """
+    Read a list of jobs from a text file. Every line is an input CSV and an output raster separated
+    by whitespace or a comma. Blank lines and lines starting with # are skipped. Relative paths are
+    relative to the manifest.
+    :param manifest: Path to the manifest file
+    :return: list of (input, output) tuples
+    """
+    root = os.path.dirname(os.path.abspath(manifest))
+    jobs = []
+    with open(manifest, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            if len(fields) != 2:
+                raise ValueError("{} line {}: expected an input and an output, got '{}'".format(manifest, lineno, line))
+            jobs.append(tuple(os.path.join(root, field) for field in fields))
+    return jobs
+
+
+def GlobJobs(pattern, outputDir):
+    """
+    Make a job for every CSV matching a glob. Outputs go in outputDir with the same name and a .tif extension
+    :param pattern: Glob pattern for the input CSVs
+    :param outputDir: Folder for the output rasters
+    :return: list of (input, output) tuples
+    """
+    return [(csv, os.path.join(outputDir, os.path.splitext(os.path.basename(csv))[0] + '.tif'))
+            for csv in sorted(glob.glob(pattern))]
+
+
+def RunBatch(jobs, templateRaster=None, workers=1, **kwargs):
+    """
+    Grid a lot of CSVs in one go. Everything shares one template (opened once) and the jobs are
+    spread across a pool of processes so we only pay the start-up costs once per worker.
+    :param jobs: list of (input CSV, output raster) tuples
+    :param templateRaster: Path to the template raster, if there is one
+    :param workers: Number of jobs to run at once. Each job gets one process
+    :param kwargs: Everything else GridRaster needs (see GridRaster)
+    :return: list of dicts, one per job, in the order the jobs finished
+    """
+    log = Logger("Batch")
+
+    # Read the template's metadata once for everyone
+    if templateRaster is not None and not isinstance(templateRaster, Raster):
+        templateRaster = Raster(filepath=templateRaster)
+
+    # Each job gets a single process. The parallelism is across jobs
+    kwargs = dict(kwargs, workers=1)
+
+    # Jobs run side by side so they have to share the memory budget
+    if kwargs.get('maxMemory') is not None and workers > 1 and len(jobs) > 1:
+        kwargs['maxMemory'] = kwargs['maxMemory'] // min(workers, len(jobs))
+
+    log.info("Running {} jobs with {} workers...".format(len(jobs), workers))
+    started = time.time()
+    results = []
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers, initializer=_initBatchWorker, initargs=(templateRaster, kwargs))
+        try:
+            for result in pool.imap_unordered(_runJob, jobs):
+                _jobSummary(log, result)
+                results.append(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        _initBatchWorker(templateRaster, kwargs)
+        for job in jobs:
+            result = _runJob(job)
+            _jobSummary(log, result)
+            results.append(result)
+
+    elapsed = time.time() - started
+    succeeded = [result for result in results if result['error'] is None]
+    points = sum(result['points'] for result in succeeded)
+    cells = sum(result['cells'] for result in succeeded)
+    log.info("Finished {} of {} jobs ({} failed) in {:.1f}s: {:.2f} jobs/s, {:,.0f} points/s, {:,.0f} cells/s".format(
+        len(succeeded), len(jobs), len(results) - len(succeeded), elapsed,
+        _rate(len(succeeded), elapsed), _rate(points, elapsed), _rate(cells, elapsed)))
+    return results
+
+
+def _initBatchWorker(templateRaster, kwargs):
+    """
+    Runs once in every pool worker
+    :param templateRaster:
+    :param kwargs:
+    :return:
+    """
+    _worker['template'] = templateRaster
+    _worker['kwargs'] = kwargs
+
+
+def _runJob(job):
+    """
+    Grid one CSV. Failures get reported rather than taking the whole batch down.
+    :param job: (input CSV, output raster)
+    :return: dict with the job, how long it took, how much it did and the error if there was one
+    """
+    inputCSV, outputRaster = job
+    result = {'input': inputCSV, 'output': outputRaster, 'points': 0, 'cells': 0, 'error': None}
+    started = time.time()
+    try:
+        outputDir = os.path.dirname(outputRaster)
+        if len(outputDir) > 0 and not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        report = GridRaster(inputCSV, outputRaster, templateRaster=_worker['template'], **_worker['kwargs'])
+        result['points'] = report['counts'].get('points', 0)
+        result['cells'] = report['counts'].get('cells', 0)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - started
+    return result
+
+
+def _jobSummary(log, result):
+    """
+    One line about how a job went
+    :param log:
+    :param result: dict from _runJob
+    :return:
+    """
+    if result['error'] is not None:
+        log.error("FAILED {} -> {} after {:.1f}s".format(result['input'], result['output'], result['seconds']),
+                  result['error'])
+    else:
+        log.info("{} -> {}: {:,} points, {:,} cells in {:.1f}s ({:,.0f} points/s)".format(
+            result['input'], result['output'], result['points'], result['cells'], result['seconds'],
+            _rate(result['points'], result['seconds'])))
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+def main():
+    #parse command line options
+    parser = argparse.ArgumentParser(description='Grid many CSV pointclouds against the same template and settings. '
+                                                 '--workers is the number of jobs to run at once.')
+    jobs = parser.add_mutually_exclusive_group(required=True)
+    jobs.add_argument('--manifest',
+                      help='Text file with an input CSV and an output raster on each line',
+                      type=str)
+    jobs.add_argument('--glob',
+                      help='Grid every CSV matching this pattern (quote it so the shell leaves it alone)',
+                      type=str)
+    parser.add_argument('--outputdir',
+                        help='Where the outputs go when using --glob (defaults to the current folder)',
+                        default='.',
+                        type=str)
+
+    AddGriddingArguments(parser)
+
+    parser.add_argument('--verbose',
+                        help = 'Get more information in your logs.',
+                        action='store_true',
+                        default=False )
+    args = parser.parse_args()
+
+    log = Logger("Program")
+
+    try:
+        if args.manifest is not None:
+            jobs = ReadManifest(args.manifest)
+        else:
+            jobs = GlobJobs(args.glob, args.outputdir)
+
+        if len(jobs) == 0:
+            log.warning("Nothing to do")
+            return
+
+        results = RunBatch(jobs, **GriddingArguments(args))
+        if any(result['error'] is not None for result in results):
+            sys.exit(1)
+    except AssertionError as e:
+        log.error("Assertion Error", e)
+        sys.exit(0)
+    except Exception as e:
+        log.error('Unexpected error: {0}'.format(sys.exc_info()[0]), e)
+        raise
+
+
+"""
+This function handles the argument parsing and calls our main function
+"""
+if __name__ == '__main__':
+    main()
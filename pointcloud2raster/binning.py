@@ -0,0 +1,62 @@
+import numpy as np
+
+# Everything BinStatistic knows how to calculate
+STATISTICS = ['mean', 'min', 'max', 'count', 'stdev', 'median']
+
+
+def BinStatistic(cells, values, ncells, statistic):
+    """
+    Reduce the values that land in each cell down to a single number. There's no
+    triangulation here so this runs in (close to) linear time in the number of points and
+    only ever needs a few ncells-sized arrays.
+    :param cells: flat cell index for each value (-1 means the value is outside the grid)
+    :param values: N array of values
+    :param ncells: Total number of cells
+    :param statistic: One of STATISTICS
+    :return: ncells array with nan in cells that didn't get any values
+    """
+    if statistic not in STATISTICS:
+        raise ValueError("Unknown statistic '{}'. Must be one of {}".format(statistic, ', '.join(STATISTICS)))
+
+    keep = cells >= 0
+    cells = cells[keep]
+    values = np.asarray(values, dtype=np.float64)[keep]
+
+    counts = np.bincount(cells, minlength=ncells)
+    empty = counts == 0
+    result = np.full(ncells, np.nan)
+
+    if np.all(empty):
+        return result
+
+    if statistic == 'count':
+        result[~empty] = counts[~empty]
+
+    elif statistic in ['mean', 'stdev']:
+        sums = np.bincount(cells, weights=values, minlength=ncells)
+        result[~empty] = sums[~empty] / counts[~empty]
+        if statistic == 'stdev':
+            # Two passes (mean first, then squared differences) so big Z values don't cost us precision
+            sqdiff = np.bincount(cells, weights=(values - result[cells]) ** 2, minlength=ncells)
+            result[~empty] = np.sqrt(sqdiff[~empty] / counts[~empty])
+
+    else:
+        # Sort-based grouping: sort by cell (then by value for the median) so every cell's
+        # values sit together and reduce each group in one vectorized call.
+        if statistic == 'median':
+            order = np.lexsort((values, cells))
+        else:
+            order = np.argsort(cells, kind='mergesort')
+        sortedValues = values[order]
+        occupied = np.flatnonzero(~empty)
+        starts = np.concatenate(([0], np.cumsum(counts[occupied])[:-1]))
+
+        if statistic == 'min':
+            result[occupied] = np.minimum.reduceat(sortedValues, starts)
+        elif statistic == 'max':
+            result[occupied] = np.maximum.reduceat(sortedValues, starts)
+        elif statistic == 'median':
+            n = counts[occupied]
+            result[occupied] = (sortedValues[starts + (n - 1) // 2] + sortedValues[starts + n // 2]) / 2.0
+
+    return result
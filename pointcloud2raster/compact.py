@@ -0,0 +1,171 @@
+import os
+import numpy as np
+from loghelper import Logger
+
+# --precision choices. 'double' keeps everything float64 like we always have
+PRECISIONS = ['double', 'compact']
+
+# Default XY step for compact points in map units (a millimetre in a metric CRS)
+DEFAULT_QUANTUM = 0.001
+
+# Rows converted at a time so the float64 temporaries stay small
+COMPACT_CHUNK = 1024 * 1024
+
+INT32_LIMIT = np.iinfo(np.int32).max
+
+
+class CompactPoints(object):
+    """
+    A point cloud stored in about half the memory of the usual N x (2 + k) float64 array: X and Y
+    as int32 multiples of a quantum away from a local origin and the values as float32. If the
+    cloud is too big for int32 steps the XY stay float64 (but still relative to the origin).
+
+    It indexes enough like the float64 array that the rest of the pipeline doesn't need to know:
+        points[idx]            A CompactPoints with just those rows
+        points[rows, col]      Column col as float64 X or Y (absolute) or float32 values
+        points[rows, cols]     Several columns. X and Y come back absolute, so this is float64
+                               unless only value columns were asked for
+        points.shape           (N, 2 + k)
+    """
+
+    def __init__(self, xy, values, origin, quantum=None):
+        """
+        :param xy: N x 2 int32 steps of quantum from the origin (or float64 offsets if quantum is None)
+        :param values: N x k float32 values
+        :param origin: (x, y) everything is relative to
+        :param quantum: Size of one XY step in map units or None when xy is float64
+        """
+        self.xy = xy
+        self.values = values
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.quantum = quantum
+
+    @classmethod
+    def fromArray(cls, data, quantum=DEFAULT_QUANTUM, origin=None):
+        """
+        Squash a loaded N x (2 + k) float64 array down
+        :param data: N x (2 + k) array of X, Y and value columns
+        :param quantum: XY step in map units. None keeps XY as float64 offsets
+        :param origin: Local origin. Defaults to the middle of the points (on a whole step)
+        :return: CompactPoints
+        """
+        log = Logger("CompactPoints")
+        npoints = data.shape[0]
+        if origin is None:
+            origin = data[:, :2].mean(axis=0) if npoints > 0 else np.zeros(2)
+            if quantum is not None:
+                origin = np.round(origin / quantum) * quantum
+
+        # int32 only stretches about 2 million metres at a millimetre
+        if npoints > 0 and quantum is not None:
+            reach = np.abs(np.concatenate((data[:, :2].min(axis=0) - origin, data[:, :2].max(axis=0) - origin))).max()
+            if reach / quantum >= INT32_LIMIT:
+                log.warning("Points are too far apart for int32 steps of {}. Keeping XY as float64".format(quantum))
+                quantum = None
+
+        xy = np.empty((npoints, 2), dtype=np.int32 if quantum is not None else np.float64)
+        values = np.empty((npoints, data.shape[1] - 2), dtype=np.float32)
+        for start in range(0, npoints, COMPACT_CHUNK):
+            chunk = data[start:start + COMPACT_CHUNK]
+            offsets = chunk[:, :2] - origin
+            if quantum is not None:
+                offsets /= quantum
+                np.rint(offsets, out=offsets)
+            xy[start:start + len(chunk)] = offsets
+            values[start:start + len(chunk)] = chunk[:, 2:]
+        return cls(xy, values, origin, quantum)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Memory-map points written by sortedCopy
+        :param filepath:
+        :return: CompactPoints
+        """
+        base = os.path.splitext(filepath)[0]
+        meta = np.load(base + '.origin.npy')
+        quantum = float(meta[2]) if np.isfinite(meta[2]) else None
+        return cls(np.load(base + '.xy.npy', mmap_mode='r'), np.load(base + '.values.npy', mmap_mode='r'),
+                   meta[:2], quantum)
+
+    @property
+    def shape(self):
+        return self.xy.shape[0], 2 + self.values.shape[1]
+
+    @property
+    def dtype(self):
+        # What a mix of columns decodes to
+        return np.dtype(np.float64)
+
+    def __len__(self):
+        return self.xy.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return CompactPoints(self.xy[key], self.values[key], self.origin, self.quantum)
+
+        rows, cols = key
+        if isinstance(cols, slice):
+            cols = list(range(*cols.indices(self.shape[1])))
+        if np.ndim(cols) == 0:
+            return self._column(rows, int(cols))
+        cols = [int(col) for col in cols]
+        if all(col >= 2 for col in cols):
+            # All of the values in order (PointValues asks for this) is just a view
+            if cols == list(range(2, self.shape[1])):
+                return self.values[rows]
+            return self.values[rows][:, [col - 2 for col in cols]]
+        return np.column_stack([self._column(rows, col) for col in cols])
+
+    def extent(self):
+        """
+        Worked out on the stored steps so nothing gets decoded
+        :return: (xmin, xmax, ymin, ymax)
+        """
+        lo = self.xy.min(axis=0).astype(np.float64)
+        hi = self.xy.max(axis=0).astype(np.float64)
+        if self.quantum is not None:
+            lo *= self.quantum
+            hi *= self.quantum
+        lo += self.origin
+        hi += self.origin
+        return lo[0], hi[0], lo[1], hi[1]
+
+    def offsetXY(self, rows=slice(None)):
+        """
+        X and Y relative to the origin without going via the absolute coordinates
+        :param rows: Which points
+        :return: N x 2 float64 array
+        """
+        xy = np.array(self.xy[rows], dtype=np.float64)
+        if self.quantum is not None:
+            xy *= self.quantum
+        return xy
+
+    def sortedCopy(self, order, filepath):
+        """
+        Write the points out in a new order so other processes can memory-map them (see CompactPoints.load)
+        :param order: Row order
+        :param filepath: .npy path to base the file names on
+        :return: read-only memory-mapped CompactPoints
+        """
+        base = os.path.splitext(filepath)[0]
+        np.save(base + '.origin.npy', np.array([self.origin[0], self.origin[1],
+                                                 self.quantum if self.quantum is not None else np.nan]))
+        for suffix, source in [('.xy.npy', self.xy), ('.values.npy', self.values)]:
+            out = np.lib.format.open_memmap(base + suffix, mode='w+', dtype=source.dtype, shape=source.shape)
+            for start in range(0, len(order), COMPACT_CHUNK):
+                out[start:start + COMPACT_CHUNK] = source[order[start:start + COMPACT_CHUNK]]
+            out.flush()
+            del out
+        return CompactPoints.load(filepath)
+
+    def _column(self, rows, col):
+        if col >= 2:
+            return self.values[rows, col - 2]
+        # One new array, scaled and shifted in place
+        xy = np.array(self.xy[rows, col], dtype=np.float64)
+        if self.quantum is not None:
+            xy *= self.quantum
+        xy += self.origin[col]
+        return xy
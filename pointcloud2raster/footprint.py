@@ -0,0 +1,225 @@
+import numpy as np
+from scipy.spatial import ConvexHull, Delaunay
+from loghelper import Logger
+from rasterize import TriangleCells
+from tricache import LoadTriangulation, SaveTriangulation
+from compact import CompactPoints
+
+try:
+    from scipy.spatial import QhullError
+except ImportError:
+    from scipy.spatial.qhull import QhullError
+
+FOOTPRINTS = ['none', 'hull', 'alpha']
+
+# With no --alpha we drop triangles with an edge longer than this many cells
+DEFAULT_ALPHA_CELLS = 5
+
+# Slack (in cells) when deciding a cell center sits on the edge of the hull
+EDGE_SLACK = 1e-9
+
+# Points we find the hull of at a time in tiled mode. The hull of the chunks' hulls is the hull
+# of everything.
+HULL_CHUNK = 4 * 1024 * 1024
+
+
+def Footprint(points, grid, origin=(0.0, 0.0), method='hull', alpha=None, tricache=None):
+    """
+    Work out which cells of the grid the data actually covers so the engines don't waste time
+    on the rest. A cell is in if its center is.
+    :param points: N x 2 array of X, Y (offset by origin)
+    :param grid: The output Grid
+    :param origin: The offset that was taken off the points
+    :param method: One of FOOTPRINTS. 'hull' is the convex hull. 'alpha' is the Delaunay
+                   triangulation without any triangles that have an edge longer than alpha so
+                   it follows concave outlines (river corridors, gaps in the survey)
+    :param alpha: Longest triangle edge to keep in map units for the alpha footprint
+    :param tricache: Folder for triangulations (see tricache.py). Lets the alpha footprint and
+                     the linear engine share one triangulation
+    :return: rows x cols boolean array or None if we can't work one out (or method is 'none')
+    """
+    log = Logger("Footprint")
+
+    if method not in FOOTPRINTS:
+        raise ValueError("Unknown footprint '{}'. Must be one of {}".format(method, ', '.join(FOOTPRINTS)))
+    if method == 'none':
+        return None
+
+    points = np.asarray(points, dtype=np.float64)
+    try:
+        if method == 'hull':
+            return HullMask(points, grid, origin)
+        return AlphaMask(points, grid, origin, AlphaDistance(grid, alpha), tricache)
+    except (QhullError, ValueError, IndexError) as e:
+        # Too few points or all in a line. Let the engines sort it out over the whole grid.
+        log.warning("Could not work out the {} footprint. Using the whole grid".format(method), e)
+        return None
+
+
+def TiledFootprint(data, grid, origin=(0.0, 0.0), method='hull', alpha=None, tricache=None):
+    """
+    Get ready to work the footprint out a tile at a time (see TileFootprint) so there's never a
+    mask for the whole grid or a triangulation of the whole cloud.
+
+    The hull is the one thing every tile needs from every point. It gets found a chunk of points
+    at a time and only its corners are kept. The alpha shape is local: a triangle with no edge
+    longer than alpha only has corners within alpha of its cells, so each tile can triangulate
+    just the points it can see. That's the same as doing the whole cloud as long as alpha isn't
+    bigger than the halo.
+
+    :param data: N x (2 + k) array (or CompactPoints) of X, Y and value columns
+    :param grid: The output Grid
+    :param origin: The offset the engines take off the points
+    :param method: One of FOOTPRINTS
+    :param alpha: Longest triangle edge to keep in map units for the alpha footprint
+    :param tricache: Folder for triangulations (see tricache.py)
+    :return: dict for TileFootprint or None (for 'none', or if we can't work one out)
+    """
+    log = Logger("Footprint")
+
+    if method not in FOOTPRINTS:
+        raise ValueError("Unknown footprint '{}'. Must be one of {}".format(method, ', '.join(FOOTPRINTS)))
+    if method == 'none':
+        return None
+    if method == 'alpha':
+        return {'method': method, 'alpha': AlphaDistance(grid, alpha), 'tricache': tricache}
+
+    try:
+        return {'method': method, 'hull': HullVertices(data, origin)}
+    except (QhullError, ValueError, IndexError) as e:
+        log.warning("Could not work out the {} footprint. Using the whole grid".format(method), e)
+        return None
+
+
+def TileFootprint(points, grid, origin, footprint):
+    """
+    The footprint of one tile
+    :param points: N x 2 array of X, Y (offset by origin) of the tile's points and its halo
+    :param grid: The tile's window of the output grid
+    :param origin: The offset that was taken off the points
+    :param footprint: dict from TiledFootprint
+    :return: rows x cols boolean array or None to grid the whole tile
+    """
+    if footprint['method'] == 'hull':
+        return ConvexMask(footprint['hull'], grid, origin)
+    if points.shape[0] < 3:
+        # No triangles so nothing is covered
+        return np.zeros((grid.rows, grid.cols), dtype=bool)
+    try:
+        return AlphaMask(points, grid, origin, footprint['alpha'], footprint.get('tricache'))
+    except (QhullError, ValueError, IndexError):
+        # All in a line. Let the engine sort it out
+        return None
+
+
+def AlphaDistance(grid, alpha=None):
+    """
+    :param grid:
+    :param alpha: Longest triangle edge in map units or None for the default
+    :return: alpha, or DEFAULT_ALPHA_CELLS cells if it wasn't given
+    """
+    if alpha is None:
+        return DEFAULT_ALPHA_CELLS * max(abs(grid.cellWidth), abs(grid.cellHeight))
+    return alpha
+
+
+def HullVertices(data, origin=(0.0, 0.0)):
+    """
+    Corners of the convex hull of a point cloud, HULL_CHUNK points at a time
+    :param data: N x (2 + k) array (or CompactPoints) of X, Y and value columns
+    :param origin: Taken off the coordinates
+    :return: M x 2 array of X, Y (offset by origin) in order around the hull
+    """
+    corners = []
+    for start in range(0, data.shape[0], HULL_CHUNK):
+        chunk = data[start:start + HULL_CHUNK]
+        xy = chunk.offsetXY() if isinstance(chunk, CompactPoints) else chunk[:, :2] - origin
+        try:
+            corners.append(xy[ConvexHull(xy).vertices])
+        except (QhullError, ValueError, IndexError):
+            # Too few points or all in a line: the extremes are all that can be on the hull
+            corners.append(xy[np.unique([xy[:, 0].argmin(), xy[:, 0].argmax(), xy[:, 1].argmin(),
+                                         xy[:, 1].argmax()])])
+    corners = np.concatenate(corners)
+    return corners[ConvexHull(corners).vertices]
+
+
+def HullMask(points, grid, origin=(0.0, 0.0)):
+    """
+    Rasterize the convex hull of the points
+    :param points: N x 2 array of X, Y (offset by origin)
+    :param grid:
+    :param origin:
+    :return: rows x cols boolean array
+    """
+    hull = ConvexHull(points)
+    return ConvexMask(points[hull.vertices], grid, origin)
+
+
+def ConvexMask(verts, grid, origin=(0.0, 0.0)):
+    """
+    Rasterize a convex polygon. It crosses every row of cell centers in a single run so we just
+    need where each row goes in and comes out.
+    :param verts: M x 2 array of the corners (offset by origin) in order around the polygon
+    :param grid:
+    :param origin:
+    :return: rows x cols boolean array
+    """
+
+    x0 = grid.left - origin[0]
+    y0 = grid.top - origin[1]
+    slack = EDGE_SLACK * abs(grid.cellHeight)
+    ys = y0 + (np.arange(grid.rows) + 0.5) * grid.cellHeight
+
+    # The leftmost and rightmost place each row of centers meets the hull
+    xmin = np.full(grid.rows, np.inf)
+    xmax = np.full(grid.rows, -np.inf)
+    for (ax, ay), (bx, by) in zip(verts, np.roll(verts, -1, axis=0)):
+        if ay == by:
+            # Flat edges get picked up by the edges either side of them
+            continue
+        rows = np.flatnonzero((ys >= min(ay, by) - slack) & (ys <= max(ay, by) + slack))
+        t = np.clip((ys[rows] - ay) / (by - ay), 0.0, 1.0)
+        xs = ax + t * (bx - ax)
+        xmin[rows] = np.minimum(xmin[rows], xs)
+        xmax[rows] = np.maximum(xmax[rows], xs)
+
+    # Turn the crossings into the first and last column whose center is inside
+    with np.errstate(invalid='ignore'):
+        ca = (xmin - x0) / grid.cellWidth - 0.5
+        cb = (xmax - x0) / grid.cellWidth - 0.5
+        c1 = np.ceil(np.minimum(ca, cb) - EDGE_SLACK)
+        c2 = np.floor(np.maximum(ca, cb) + EDGE_SLACK)
+    missed = ~np.isfinite(c1) | ~np.isfinite(c2)
+    c1[missed] = 0
+    c2[missed] = -1
+
+    cols = np.arange(grid.cols)
+    return (cols[np.newaxis, :] >= c1[:, np.newaxis]) & (cols[np.newaxis, :] <= c2[:, np.newaxis])
+
+
+def AlphaMask(points, grid, origin, alpha, tricache=None):
+    """
+    Rasterize the Delaunay triangles that don't have an edge longer than alpha
+    :param points: N x 2 array of X, Y (offset by origin)
+    :param grid:
+    :param origin:
+    :param alpha: Longest edge to keep in map units
+    :param tricache: Folder for triangulations or None
+    :return: rows x cols boolean array
+    """
+    simplices = LoadTriangulation(tricache, points) if tricache else None
+    if simplices is None:
+        tri = Delaunay(points, qhull_options="QJ")
+        simplices = tri.simplices
+        if tricache:
+            SaveTriangulation(tricache, points, tri)
+
+    corners = points[simplices]
+    edges = corners - np.roll(corners, 1, axis=1)
+    longest = np.sqrt((edges ** 2).sum(axis=2)).max(axis=1)
+
+    mask = np.zeros(grid.rows * grid.cols, dtype=bool)
+    for tri, cells, weights in TriangleCells(points, simplices[longest <= alpha], grid, origin):
+        mask[cells] = True
+    return mask.reshape(grid.rows, grid.cols)
@@ -0,0 +1,155 @@
+import math
+import numpy as np
+
+# How close (in cells) a point has to be to the far edge of the grid to count as on it
+EDGE_TOLERANCE = 1e-6
+
+
+class Grid(object):
+    """
+    The geometry of a north-up raster: where it sits, how big the cells are and how many there are.
+
+    Cell (row, col) has its center at:
+        x = left + (col + 0.5) * cellWidth
+        y = top + (row + 0.5) * cellHeight
+
+    cellHeight is negative for a normal north-up raster, just like in a GDAL geotransform.
+    """
+
+    def __init__(self, left, top, cellWidth, cellHeight, rows, cols):
+        self.left = float(left)
+        self.top = float(top)
+        self.cellWidth = float(cellWidth)
+        self.cellHeight = float(cellHeight)
+        self.rows = int(rows)
+        self.cols = int(cols)
+
+    @classmethod
+    def fromExtent(cls, left, right, top, bottom, cellWidth, cellHeight):
+        """
+        Build a grid from edges that already fall on cell boundaries
+        :param left:
+        :param right:
+        :param top:
+        :param bottom:
+        :param cellWidth:
+        :param cellHeight:
+        :return:
+        """
+        rows = int(round((bottom - top) / cellHeight))
+        cols = int(round((right - left) / cellWidth))
+        return cls(left, top, cellWidth, cellHeight, rows, cols)
+
+    def window(self, xoff, yoff, cols, rows):
+        """
+        A sub-grid starting at cell (yoff, xoff)
+        :param xoff: column offset
+        :param yoff: row offset
+        :param cols:
+        :param rows:
+        :return:
+        """
+        return Grid(self.left + xoff * self.cellWidth, self.top + yoff * self.cellHeight,
+                    self.cellWidth, self.cellHeight, rows, cols)
+
+    def tiles(self, tileSize):
+        """
+        Walk the grid in square tiles (the ones on the right and bottom edges may be smaller)
+        :param tileSize: tile width and height in cells
+        :return: generator of (xoff, yoff, cols, rows)
+        """
+        for yoff in range(0, self.rows, tileSize):
+            for xoff in range(0, self.cols, tileSize):
+                yield xoff, yoff, min(tileSize, self.cols - xoff), min(tileSize, self.rows - yoff)
+
+    def tileCount(self, tileSize):
+        """
+        :param tileSize:
+        :return: (tile columns, tile rows)
+        """
+        return int(math.ceil(float(self.cols) / tileSize)), int(math.ceil(float(self.rows) / tileSize))
+
+    def bounds(self, halo=0):
+        """
+        The outside edges of the grid, optionally grown by a number of cells on every side
+        :param halo: Number of cells to grow by
+        :return: (xmin, xmax, ymin, ymax)
+        """
+        x1 = self.left - halo * self.cellWidth
+        x2 = self.left + (self.cols + halo) * self.cellWidth
+        y1 = self.top - halo * self.cellHeight
+        y2 = self.top + (self.rows + halo) * self.cellHeight
+        return min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+
+    def cellIndex(self, x, y, origin=(0.0, 0.0)):
+        """
+        Work out which cell each point falls in. Cells include their left and top edges. The
+        grid's extent comes from rounding the data out to whole cells so points sitting exactly on
+        its right or bottom edge go in the last column or row rather than getting lost.
+        :param x: X coordinates
+        :param y: Y coordinates
+        :param origin: The offset that was taken off the coordinates
+        :return: flat (row * cols + col) cell index for each point, -1 for points outside the grid
+        """
+        col = self._edgeIndex((x - (self.left - origin[0])) / self.cellWidth, self.cols)
+        row = self._edgeIndex((y - (self.top - origin[1])) / self.cellHeight, self.rows)
+        inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        return np.where(inside, row * self.cols + col, -1)
+
+    @staticmethod
+    def _edgeIndex(u, count):
+        """
+        :param u: Positions in cells from the first edge
+        :param count: Number of cells
+        :return: int64 cell number for each position, with the far edge (give or take float
+                 rounding from the origin offset) counted as part of the last cell
+        """
+        index = np.floor(u).astype(np.int64)
+        return np.where((index == count) & (u - count <= EDGE_TOLERANCE), count - 1, index)
+
+    def cellCenterAxes(self, origin=(0.0, 0.0), dtype=np.float64):
+        """
+        The X of every column's centers and the Y of every row's centers. Everything else about
+        the cell centers can be built from these two.
+        :param origin: Subtracted from the coordinates (so they line up with offset points)
+        :param dtype: Type of the coordinates. They're worked out in float64 and then converted
+        :return: (xs, ys) of length cols and rows
+        """
+        xs = self.left + (np.arange(self.cols) + 0.5) * self.cellWidth - origin[0]
+        ys = self.top + (np.arange(self.rows) + 0.5) * self.cellHeight - origin[1]
+        return xs.astype(dtype, copy=False), ys.astype(dtype, copy=False)
+
+    def cellCenterBlocks(self, blockRows, origin=(0.0, 0.0), dtype=np.float64):
+        """
+        Walk the cell centers a block of whole rows at a time so we never hold more than
+        blockRows x cols of coordinates no matter how big the grid is.
+
+        The same two buffers get filled in place for every block. Use (or copy) them before
+        asking for the next one.
+
+        :param blockRows: Rows per block (the last block may be smaller)
+        :param origin: Subtracted from the coordinates (so they line up with offset points)
+        :param dtype: Type of the coordinates
+        :return: generator of (rows slice, x, y) with x and y each n x cols
+        """
+        xs, ys = self.cellCenterAxes(origin, dtype)
+        blockRows = max(1, min(int(blockRows), self.rows))
+        x = np.empty((blockRows, self.cols), dtype=dtype)
+        y = np.empty((blockRows, self.cols), dtype=dtype)
+        # Every row has the same X so that only needs filling once
+        x[:] = xs
+        for row in range(0, self.rows, blockRows):
+            n = min(blockRows, self.rows - row)
+            y[:n] = ys[row:row + n, np.newaxis]
+            yield slice(row, row + n), x[:n], y[:n]
+
+    def cellCenters(self, origin=(0.0, 0.0), dtype=np.float64):
+        """
+        X and Y coordinates of every cell center. This is two full rows x cols arrays so prefer
+        cellCenterBlocks for anything big.
+        :param origin: Subtracted from the coordinates (so they line up with offset points)
+        :param dtype: Type of the coordinates
+        :return: (x, y) each a rows x cols array
+        """
+        xs, ys = self.cellCenterAxes(origin, dtype)
+        return tuple(np.meshgrid(xs, ys))
@@ -0,0 +1,174 @@
+import os
+import sys
+import argparse
+import numpy as np
+from loghelper import Logger
+from raster import Raster
+from grid import Grid
+from pointcache import LoadCachedPoints, CACHE_MODES
+from tiling import GridTiles
+from thinning import ThinPoints
+from compact import CompactPoints
+from provenance import ReadProvenance, WriteProvenance, TouchedTiles, SourceRecord, SourcePath, SourceChanged
+
+
+def UpdateRaster(sDeltaCSV, sRaster, workers=1, cache='off'):
+    """
+    Fold new points into a raster that was gridded with provenance=True without gridding the
+    whole thing again.
+
+    The sidecar tells us the settings, the tile size and which tiles every earlier input touched.
+    Only the tiles the new points can see (their window plus the halo) get gridded again, from
+    the new points and whichever earlier inputs touch those tiles, and they're written back into
+    the raster in place. The new file then becomes one more input in the sidecar.
+
+    The patched tiles come out just like they would from a tiled run over all the inputs with the
+    same tile size and halo. The raster can't grow so new points outside it are left out.
+
+    :param sDeltaCSV: Point cloud with the new points. Same columns as the original input(s)
+    :param sRaster: Raster to patch. Must have a provenance sidecar (see provenance.py)
+    :param workers: Number of processes to use for loading and gridding
+    :param cache: Point cache mode for every cloud we load. One of 'off', 'on', 'rebuild', 'purge'
+    :return: dict of how many new points went in and how many tiles got gridded again
+    """
+    log = Logger("UpdateRaster")
+    provenance = ReadProvenance(sRaster)
+    settings = provenance['settings']
+    if settings['footprint'] != 'none':
+        raise ValueError("{} was gridded with --footprint {}. New points can move the footprint anywhere so it has "
+                         "to be gridded again from scratch".format(sRaster, settings['footprint']))
+
+    raster = Raster(filepath=sRaster)
+    g = provenance['grid']
+    grid = Grid(g['left'], g['top'], g['cellWidth'], g['cellHeight'], g['rows'], g['cols'])
+    if (raster.rows, raster.cols) != (grid.rows, grid.cols) or \
+            not np.allclose([raster.left, raster.top], [grid.left, grid.top]):
+        raise ValueError("{} doesn't match its provenance sidecar. Was it gridded again without --provenance?".format(
+            sRaster))
+
+    tileSize = provenance['tileSize']
+    halo = settings['halo']
+    origin = np.array(provenance['origin'])
+    usecols = (settings['xfield'] - 1, settings['yfield'] - 1) + tuple(z - 1 for z in settings['zfields'])
+
+    log.info("Loading new points...")
+    delta = LoadCachedPoints(sDeltaCSV, usecols, workers=workers, mode=cache)
+    npoints = delta.shape[0]
+    inside = grid.cellIndex(delta[:, 0], delta[:, 1]) >= 0
+    if not inside.all():
+        log.warning("{} of {} new points are outside {} and have been left out. Grid everything again to take them "
+                    "in".format(int((~inside).sum()), npoints, sRaster))
+        delta = delta[inside]
+    del inside
+
+    affected = TouchedTiles(delta, grid, tileSize, halo)
+    tileCols, tileRows = grid.tileCount(tileSize)
+    log.info("{} new points touch {} of {} tiles".format(delta.shape[0], len(affected), tileCols * tileRows))
+
+    if len(affected) > 0:
+        chunks = []
+        for source in provenance['sources']:
+            if len(np.intersect1d(source['tiles'], affected)) == 0:
+                continue
+            sSource = SourcePath(source, sRaster)
+            if not os.path.isfile(sSource):
+                raise ValueError("{} is missing. The tiles near the new points need it".format(sSource))
+            if SourceChanged(source, sRaster):
+                log.warning("{} has changed since it was gridded. Only the tiles near the new points will see the "
+                            "changes".format(sSource))
+            log.info("Loading {}...".format(sSource))
+            chunks.append(_nearbyPoints(LoadCachedPoints(sSource, usecols, workers=workers, mode=cache), grid,
+                                        tileSize, affected, halo))
+        # New points go last, just like they would at the end of one big file
+        chunks.append(_nearbyPoints(delta, grid, tileSize, affected, halo))
+        points = np.concatenate(chunks)
+        del chunks
+
+        if settings['thin'] != 'none':
+            points = ThinPoints(points, grid, settings['thin'], settings['thinKeep'])
+        if settings['precision'] == 'compact':
+            points = CompactPoints.fromArray(points, settings['quantum'], origin)
+
+        log.info("Gridding {} tiles again from {} points...".format(len(affected), points.shape[0]))
+        raster.update()
+        try:
+            GridTiles(points, grid, raster, tileSize, halo, origin, settings['method'], workers=workers,
+                      options=settings['options'], tiles=affected)
+        finally:
+            raster.close()
+
+    provenance['sources'].append(SourceRecord(sDeltaCSV, sRaster, npoints, affected))
+    WriteProvenance(sRaster, grid, tileSize, origin, settings, provenance['sources'])
+
+    log.info("Done. {} tiles of {} updated".format(len(affected), sRaster))
+    return {'points': int(delta.shape[0]), 'tiles': len(affected)}
+
+
+def _nearbyPoints(data, grid, tileSize, tiles, halo):
+    """
+    Cut a cloud down to the points that are in some tiles or close enough to be in their halos.
+    Whole tiles at a time so every cell stays whole for thinning.
+    :param data: N x (2 + k) array of X, Y and value columns
+    :param grid: The output Grid
+    :param tileSize:
+    :param tiles: Flat tile numbers
+    :param halo: Halo in cells
+    :return: M x (2 + k) array in the same order
+    """
+    tileCols, tileRows = grid.tileCount(tileSize)
+    reach = halo // tileSize + 1
+    wanted = np.zeros((tileRows, tileCols), dtype=bool)
+    rows, cols = np.divmod(np.asarray(tiles), tileCols)
+    for dy in range(-reach, reach + 1):
+        for dx in range(-reach, reach + 1):
+            wanted[np.clip(rows + dy, 0, tileRows - 1), np.clip(cols + dx, 0, tileCols - 1)] = True
+
+    tx = np.floor((data[:, 0] - grid.left) / (tileSize * grid.cellWidth)).astype(np.int64)
+    ty = np.floor((data[:, 1] - grid.top) / (tileSize * grid.cellHeight)).astype(np.int64)
+    np.clip(tx, 0, tileCols - 1, out=tx)
+    np.clip(ty, 0, tileRows - 1, out=ty)
+    return data[wanted[ty, tx]]
+
+
+def main():
+    #parse command line options
+    parser = argparse.ArgumentParser(description='Fold new points into a raster gridded with --provenance. Only the '
+                                                 'tiles near the new points get gridded again.')
+    parser.add_argument('deltafile',
+                        help='Point cloud with the new points. Same columns as the original input',
+                        type=argparse.FileType('r'))
+    parser.add_argument('raster',
+                        help='Raster to update in place. Needs the .p2r.json sidecar --provenance writes',
+                        type=str)
+    parser.add_argument('--workers',
+                        help='Number of processes to use for loading and gridding (defaults to 1)',
+                        default=1,
+                        type=int)
+    parser.add_argument('--cache',
+                        help='Binary point cache next to each CSV. One of "off", "on", "rebuild", "purge" Default: off',
+                        default='off',
+                        choices=CACHE_MODES,
+                        type=str)
+    parser.add_argument('--verbose',
+                        help = 'Get more information in your logs.',
+                        action='store_true',
+                        default=False )
+    args = parser.parse_args()
+
+    log = Logger("Program")
+
+    try:
+        UpdateRaster(args.deltafile.name, args.raster, workers=args.workers, cache=args.cache)
+    except AssertionError as e:
+        log.error("Assertion Error", e)
+        sys.exit(0)
+    except Exception as e:
+        log.error('Unexpected error: {0}'.format(sys.exc_info()[0]), e)
+        raise
+
+
+"""
+This function handles the argument parsing and calls our main function
+"""
+if __name__ == '__main__':
+    main()
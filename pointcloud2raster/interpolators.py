@@ -0,0 +1,380 @@
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator, CloughTocher2DInterpolator
+from scipy.spatial import Delaunay, cKDTree
+from binning import BinStatistic
+from rasterize import RasterizeLinear
+from tricache import LoadTriangulation, SaveTriangulation
+
+
+class Interpolator(object):
+    """
+    Base class for the gridding engines.
+
+    An engine gets built from a set of points (already shifted by the origin offset) and their
+    values. It can then be evaluated at any X, Y coordinates or onto the cell centers of a Grid.
+    Anywhere an engine can't give an answer comes back as nan.
+
+    The values can be N x k to interpolate k columns at once from the same points. Whatever the
+    engine works out from the XY (triangles, neighbours, cells) is shared by every column and
+    the results get an extra last axis of length k.
+
+    Every engine understands the dtype option: the type of the grids interpolate() hands back
+    (default float64). float32 halves the size of the output and loses nothing once it's written
+    to a Float32 raster.
+    """
+
+    # Fewer points than this and the engine can't do anything useful
+    minPoints = 1
+
+    # Cells worth of coordinates we build at a time when interpolating onto a grid
+    BLOCK_CELLS = 256 * 1024
+
+    def __init__(self, points, values, log=None, **options):
+        """
+        :param points: N x 2 array of X, Y (offset so they sit around the origin)
+        :param values: N array of Z (or N x k for several columns)
+        :param log: If given, stage messages go here
+        :param options: Engine-specific settings. Engines ignore the ones they don't use
+        """
+        self.points = points
+        self.values = values
+        self.log = log
+        self.options = options
+        self.dtype = np.dtype(options.get('dtype') or np.float64)
+
+    def __call__(self, x, y):
+        """
+        Evaluate the surface
+        :param x: array of X coordinates (in the same offset space as the points)
+        :param y: array of Y coordinates, same shape as x
+        :return: array of values, same shape as x (plus a last axis of k for N x k values)
+        """
+        raise NotImplementedError
+
+    def interpolate(self, grid, origin_offset, mask=None):
+        """
+        Evaluate the surface at every cell center of a grid
+        :param grid: The Grid to interpolate onto
+        :param origin_offset: The offset that was taken off the points
+        :param mask: rows x cols boolean array (see footprint.py). Only cells where it's True
+                     get evaluated. The rest are nan
+        :return: rows x cols array (rows x cols x k for N x k values)
+        """
+        # The cell centers get built a block of rows at a time (straight into the offset space
+        # and in the output dtype) so the only full-size array is the result
+        result = np.empty((grid.rows, grid.cols) + np.shape(self.values)[1:], dtype=self.dtype)
+        for rows, x, y in grid.cellCenterBlocks(self.blockRows(grid), origin_offset, self.dtype):
+            result[rows] = self._evaluate(x, y, mask[rows] if mask is not None else None)
+        return result
+
+    def blockRows(self, grid):
+        """
+        :param grid:
+        :return: How many rows of the grid make up BLOCK_CELLS cells
+        """
+        return max(1, self.BLOCK_CELLS // max(1, grid.cols))
+
+    def _evaluate(self, x, y, mask=None):
+        """
+        Evaluate the surface only where mask is True
+        :param x:
+        :param y:
+        :param mask: boolean array the same shape as x or None for everywhere
+        :return:
+        """
+        if mask is None:
+            return self(x, y)
+        result = np.full(x.shape + np.shape(self.values)[1:], np.nan, dtype=self.dtype)
+        if mask.any():
+            result[mask] = self(x[mask], y[mask])
+        return result
+
+    def _info(self, message):
+        if self.log is not None:
+            self.log.info(message)
+
+
+class LinearInterpolator(Interpolator):
+    """
+    Linear interpolation across a Delaunay triangulation of the points.
+
+    Onto a grid we rasterize the triangles directly (see rasterize.py) instead of looking up
+    the triangle for every cell. Arbitrary coordinates still go through LinearNDInterpolator.
+
+    Options:
+        tricache: Folder to keep triangulations in (see tricache.py). When the same XY comes
+                  round again the triangles come from there and QHull never gets called.
+    """
+    minPoints = 3
+
+    def __init__(self, points, values, log=None, **options):
+        super(LinearInterpolator, self).__init__(points, values, log, **options)
+        self.tri = None
+        self.function = None
+
+        cacheDir = options.get('tricache')
+        self.simplices = LoadTriangulation(cacheDir, points) if cacheDir else None
+        if self.simplices is None:
+            self.tri = _triangulate(points, self._info)
+            self.simplices = self.tri.simplices
+            if cacheDir:
+                SaveTriangulation(cacheDir, points, self.tri)
+
+    def __call__(self, x, y):
+        if self.function is None:
+            # A cached triangulation doesn't have the search structures LinearNDInterpolator needs
+            if self.tri is None:
+                self.tri = _triangulate(self.points, self._info)
+            self.function = LinearNDInterpolator(self.tri, self.values, fill_value=np.nan)
+        return self.function((x, y))
+
+    def interpolate(self, grid, origin_offset, mask=None):
+        # Rasterizing never visits cells outside the triangles so the mask doesn't save us anything
+        result = RasterizeLinear(self.points, self.simplices, self.values, grid, origin_offset, self.dtype)
+        if mask is not None:
+            result[~mask] = np.nan
+        return result
+
+
+class CubicInterpolator(Interpolator):
+    """
+    Piecewise cubic (Clough-Tocher) interpolation across a Delaunay triangulation of the points
+    """
+    minPoints = 3
+
+    def __init__(self, points, values, log=None, **options):
+        super(CubicInterpolator, self).__init__(points, values, log, **options)
+        self.tri = _triangulate(points, self._info)
+        self._info("Creating Interpolator...")
+        self.function = CloughTocher2DInterpolator(self.tri, values, fill_value=np.nan)
+
+    def __call__(self, x, y):
+        return self.function((x, y))
+
+
+class NearestInterpolator(Interpolator):
+    """
+    Nearest neighbour using a KD-tree. There's no triangulation so this is much cheaper
+    than the other engines on dense clouds.
+    """
+
+    def __init__(self, points, values, log=None, **options):
+        super(NearestInterpolator, self).__init__(points, values, log, **options)
+        self._info("Creating KD-Tree...")
+        self.tree = cKDTree(points)
+
+    def __call__(self, x, y):
+        x = np.asarray(x)
+        dist, idx = self.tree.query(np.column_stack((x.ravel(), np.asarray(y).ravel())), k=1)
+        values = np.asarray(self.values)
+        return values[idx].reshape(x.shape + values.shape[1:])
+
+
+class IDWInterpolator(Interpolator):
+    """
+    Inverse distance weighting of the k nearest points using a KD-tree.
+
+    Options:
+        power:  Distance exponent (default 2)
+        k:      Maximum number of neighbours to use (default 12)
+        radius: Ignore points further away than this, in map units (default: no limit)
+        threads: Number of threads to query row blocks of the grid with (default 1)
+
+    Cells with no points inside the radius come out as nan.
+    """
+
+    def __init__(self, points, values, log=None, **options):
+        super(IDWInterpolator, self).__init__(points, values, log, **options)
+        self.power = float(options.get('power') or 2.0)
+        self.k = int(min(options.get('k') or 12, points.shape[0]))
+        self.radius = options.get('radius') or np.inf
+        self.threads = int(options.get('threads') or 1)
+        self._info("Creating KD-Tree...")
+        self.tree = cKDTree(points)
+
+    def __call__(self, x, y):
+        x = np.asarray(x)
+        dist, idx = self.tree.query(np.column_stack((x.ravel(), np.asarray(y).ravel())), k=self.k,
+                                    distance_upper_bound=self.radius)
+        # k=1 gives us flat arrays back
+        dist = dist.reshape(-1, self.k)
+        idx = idx.reshape(-1, self.k)
+
+        # Neighbours that weren't found inside the radius come back as idx == N and dist == inf
+        found = idx < self.points.shape[0]
+        allValues = np.asarray(self.values)
+        values = allValues[np.where(found, idx, 0)]
+
+        with np.errstate(divide='ignore'):
+            weights = np.where(found, 1.0 / dist ** self.power, 0.0)
+
+        # Sitting right on top of a point means we just take its value
+        exact = found & (dist == 0)
+        hit = exact.any(axis=1)
+        weights[hit] = exact[hit]
+
+        # Normalise once and share the weights between every value column
+        totals = weights.sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            weights /= totals[:, np.newaxis]
+        result = np.einsum('ij,ij...->i...', weights, values)
+        result[totals == 0] = np.nan
+        return result.reshape(x.shape + allValues.shape[1:])
+
+    def interpolate(self, grid, origin_offset, mask=None):
+        blockRows = self.blockRows(grid)
+        starts = range(0, grid.rows, blockRows)
+        if self.threads <= 1 or len(starts) <= 1:
+            return super(IDWInterpolator, self).interpolate(grid, origin_offset, mask)
+
+        # Every thread builds its own block of cell centers from the axes and writes its own rows
+        xs, ys = grid.cellCenterAxes(origin_offset, self.dtype)
+        result = np.empty((grid.rows, grid.cols) + np.shape(self.values)[1:], dtype=self.dtype)
+
+        def evaluate(row):
+            rows = slice(row, min(row + blockRows, grid.rows))
+            x, y = np.meshgrid(xs, ys[rows])
+            result[rows] = self._evaluate(x, y, mask[rows] if mask is not None else None)
+
+        # The KD-tree query releases the GIL so threads give us real parallelism here
+        pool = ThreadPool(self.threads)
+        pool.map(evaluate, starts)
+        pool.close()
+        pool.join()
+        return result
+
+
+class BinningInterpolator(Interpolator):
+    """
+    Not really an interpolator: every cell gets a statistic of the points that fall inside it
+    and cells without any points are left empty. Good for dense clouds with several points per
+    cell where a triangulation is overkill.
+
+    A footprint mask is ignored: only cells with points in them get a value anyway and we'd
+    rather not throw away a cell on the edge just because its center is outside the hull.
+    """
+    statistic = None
+
+    def __call__(self, x, y):
+        raise NotImplementedError("Binning only works onto a grid. Use interpolate()")
+
+    def interpolate(self, grid, origin_offset, mask=None):
+        cells = grid.cellIndex(self.points[:, 0], self.points[:, 1], origin_offset)
+        values = np.asarray(self.values)
+        if values.ndim == 1:
+            result = BinStatistic(cells, values, grid.rows * grid.cols, self.statistic)
+            return result.astype(self.dtype, copy=False).reshape(grid.rows, grid.cols)
+        result = np.empty((grid.rows * grid.cols, values.shape[1]), dtype=self.dtype)
+        for col in range(values.shape[1]):
+            result[:, col] = BinStatistic(cells, values[:, col], grid.rows * grid.cols, self.statistic)
+        return result.reshape(grid.rows, grid.cols, values.shape[1])
+
+
+class BinMean(BinningInterpolator):
+    statistic = 'mean'
+
+
+class BinMin(BinningInterpolator):
+    statistic = 'min'
+
+
+class BinMax(BinningInterpolator):
+    statistic = 'max'
+
+
+class BinCount(BinningInterpolator):
+    statistic = 'count'
+
+
+class BinStdev(BinningInterpolator):
+    statistic = 'stdev'
+
+
+class BinMedian(BinningInterpolator):
+    statistic = 'median'
+
+
+# Every --method we know about
+ENGINES = {
+    'linear': LinearInterpolator,
+    'cubic': CubicInterpolator,
+    'nearest': NearestInterpolator,
+    'idw': IDWInterpolator,
+    'mean': BinMean,
+    'min': BinMin,
+    'max': BinMax,
+    'count': BinCount,
+    'stdev': BinStdev,
+    'median': BinMedian,
+}
+
+
+def CreateInterpolator(points, values, origin_offset, method='linear', log=None, options=None, offset=True):
+    """
+    Build an engine for a set of points
+    :param points: N x 2 array of X, Y
+    :param values: N array of Z (or N x k for several columns)
+    :param origin_offset: Subtracted from every coordinate so QHull stays happy
+    :param method: One of the keys in ENGINES
+    :param log: If given, stage messages go here
+    :param options: dict of engine-specific settings
+    :param offset: False if origin_offset has already been taken off the points (CompactPoints.offsetXY)
+                   so we don't make another copy of them
+    :return: An Interpolator or None if there aren't enough points for this method
+    """
+    if method not in ENGINES:
+        raise ValueError("Unknown method '{}'. Must be one of {}".format(method, ', '.join(sorted(ENGINES))))
+    engine = ENGINES[method]
+
+    if points.shape[0] < engine.minPoints:
+        return None
+
+    return engine(points - origin_offset if offset else points, values, log=log, **(options or {}))
+
+
+def InterpolateGrid(points, values, grid, origin_offset, method='linear', log=None, options=None, mask=None,
+                    offset=True):
+    """
+    Interpolate a set of points onto the cell centers of a grid
+    :param points: N x 2 array of X, Y
+    :param values: N array of Z (or N x k for several columns)
+    :param grid: The Grid to interpolate onto
+    :param origin_offset: Subtracted from every coordinate so QHull stays happy
+    :param method: One of the keys in ENGINES
+    :param log: If given, stage messages go here
+    :param options: dict of engine-specific settings
+    :param mask: rows x cols boolean footprint. Cells outside it are skipped and come out nan
+    :param offset: False if origin_offset has already been taken off the points
+    :return: rows x cols array (rows x cols x k for N x k values) with nan anywhere the engine
+             couldn't give us a value
+    """
+    interpolationfunction = CreateInterpolator(points, values, origin_offset, method, log, options, offset)
+    if interpolationfunction is None:
+        return np.full((grid.rows, grid.cols) + np.shape(values)[1:], np.nan, dtype=(options or {}).get('dtype'))
+
+    # Now we have our interpolation function. Throw a grid of XY coords at it (not forgetting to offset)
+    if log is not None:
+        log.info("Interpolating Points...")
+    return interpolationfunction.interpolate(grid, origin_offset, mask)
+
+
+def PointValues(data):
+    """
+    The value column(s) of a loaded point array
+    :param data: N x (2 + k) array of X, Y and k value columns
+    :return: N array when there's one value column, otherwise N x k
+    """
+    return data[:, 2] if data.shape[1] == 3 else data[:, 2:]
+
+
+def _triangulate(points, info):
+    """
+    Delaunay triangulation of the (offset) points
+    :param points:
+    :param info: Where to send the stage message
+    :return:
+    """
+    # QHull option QJ ensures we don't throw away any points
+    info("Creating Delaunay Triangles...")
+    return Delaunay(points, qhull_options="QJ")
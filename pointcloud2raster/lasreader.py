@@ -0,0 +1,140 @@
+import os
+import struct
+import numpy as np
+from loghelper import Logger
+
+# Every LAS file starts with this
+LAS_MAGIC = b'LASF'
+
+# Columns we can pull out of a LAS point record, numbered like CSV columns so --xfield, --yfield
+# and --zfield work the same way (1-indexed on the command line):
+#   1 X, 2 Y, 3 Z, 4 intensity, 5 classification, 6 GPS time
+LAS_COLUMNS = ['X', 'Y', 'Z', 'intensity', 'classification', 'gpstime']
+
+# Records converted at a time. Bounds the temporaries when the file is much bigger than memory.
+LAS_CHUNK_POINTS = 4 * 1024 * 1024
+
+
+class LASHeader(object):
+    """
+    The parts of a LAS 1.0 - 1.4 public header block we need to find and decode the point records
+    """
+
+    def __init__(self, sInputLAS):
+        with open(sInputLAS, 'rb') as f:
+            raw = f.read(375)
+
+        if len(raw) < 227 or raw[:4] != LAS_MAGIC:
+            raise ValueError("{} is not a LAS file".format(sInputLAS))
+
+        self.versionMajor, self.versionMinor = struct.unpack_from('<BB', raw, 24)
+        self.headerSize, self.pointOffset = struct.unpack_from('<HI', raw, 94)
+        pointFormat, self.recordLength, legacyCount = struct.unpack_from('<BHI', raw, 104)
+        self.scale = np.array(struct.unpack_from('<3d', raw, 131))
+        self.offset = np.array(struct.unpack_from('<3d', raw, 155))
+        maxX, minX, maxY, minY, maxZ, minZ = struct.unpack_from('<6d', raw, 179)
+        self.extent = (minX, maxX, minY, maxY, minZ, maxZ)
+
+        # LAZ sets the top bits of the format to say the records are compressed
+        if pointFormat & 0xC0:
+            raise ValueError("{} has compressed (LAZ) point records. Decompress it to LAS first".format(sInputLAS))
+        self.pointFormat = pointFormat
+
+        # 1.4 moved the point count to a 64 bit field and may leave the old one as 0
+        self.pointCount = legacyCount
+        if (self.versionMajor, self.versionMinor) >= (1, 4) and len(raw) >= 255:
+            self.pointCount = struct.unpack_from('<Q', raw, 247)[0] or legacyCount
+
+    def dtype(self):
+        """
+        A structured dtype laid over one point record. We only name the fields we read and let
+        itemsize skip over everything else (including any extra bytes).
+        :return:
+        """
+        names = ['X', 'Y', 'Z', 'intensity']
+        formats = ['<i4', '<i4', '<i4', '<u2']
+        offsets = [0, 4, 8, 12]
+
+        # Formats 6-10 shuffled the bit fields around and gave classification a whole byte
+        if self.pointFormat < 6:
+            names.append('classification')
+            formats.append('u1')
+            offsets.append(15)
+            if self.pointFormat in [1, 3, 4, 5]:
+                names.append('gpstime')
+                formats.append('<f8')
+                offsets.append(20)
+        else:
+            names += ['classification', 'gpstime']
+            formats += ['u1', '<f8']
+            offsets += [16, 22]
+
+        return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': self.recordLength})
+
+
+def IsLAS(sInput):
+    """
+    :param sInput: Path to a point cloud
+    :return: True if the file starts with the LAS signature
+    """
+    with open(sInput, 'rb') as f:
+        return f.read(4) == LAS_MAGIC
+
+
+def LoadLASPoints(sInputLAS, usecols):
+    """
+    Load the selected columns of an uncompressed LAS (1.0 - 1.4) file.
+
+    The point records get memory-mapped with a structured dtype so there's no parsing at all:
+    we just scale and offset the integer coordinates a chunk at a time into a float array.
+
+    :param sInputLAS: Path to the LAS file
+    :param usecols: Zero-indexed column numbers (see LAS_COLUMNS) in output order
+    :return: N x len(usecols) float64 array
+    """
+    log = Logger("LoadLASPoints")
+    usecols = tuple(usecols)
+
+    header = LASHeader(sInputLAS)
+    dtype = header.dtype()
+    log.debug("LAS {}.{} point format {}: {} points of {} bytes".format(header.versionMajor, header.versionMinor,
+                                                                       header.pointFormat, header.pointCount,
+                                                                       header.recordLength))
+
+    fields = []
+    for col in usecols:
+        if col < 0 or col >= len(LAS_COLUMNS):
+            raise ValueError("Column {} requested but LAS files only have columns 1-{} ({})".format(
+                col + 1, len(LAS_COLUMNS), ', '.join(LAS_COLUMNS)))
+        if LAS_COLUMNS[col] not in dtype.names:
+            raise ValueError("Column {} ({}) requested but point format {} in {} doesn't have it".format(
+                col + 1, LAS_COLUMNS[col], header.pointFormat, sInputLAS))
+        fields.append(LAS_COLUMNS[col])
+
+    available = (os.path.getsize(sInputLAS) - header.pointOffset) // header.recordLength
+    if available < header.pointCount:
+        raise ValueError("{} says it has {} points but there's only room for {}".format(
+            sInputLAS, header.pointCount, available))
+
+    result = np.empty((header.pointCount, len(usecols)))
+    if header.pointCount == 0:
+        return result
+
+    records = np.memmap(sInputLAS, dtype=dtype, mode='r', offset=header.pointOffset, shape=(header.pointCount,))
+    for start in range(0, header.pointCount, LAS_CHUNK_POINTS):
+        chunk = records[start:start + LAS_CHUNK_POINTS]
+        for idx, field in enumerate(fields):
+            out = result[start:start + len(chunk), idx]
+            values = chunk[field]
+            if field == 'classification' and header.pointFormat < 6:
+                # The top three bits are the synthetic, key-point and withheld flags
+                values = values & 0x1F
+            out[:] = values
+            # Only the coordinates are stored as scaled integers
+            axis = LAS_COLUMNS.index(field)
+            if axis < 3:
+                out *= header.scale[axis]
+                out += header.offset[axis]
+    del records
+
+    return result
@@ -1,9 +1,15 @@
-import os, sys, xml, datetime, pytz, re
+import os, sys, xml, datetime, pytz, re, time, atexit
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
 import logging, logging.handlers
 from pprint import pformat
 
+# XML messages get buffered and written out when either of these is exceeded (or at exit)
+XML_FLUSH_SECONDS = 5.0
+XML_FLUSH_BYTES = 64 * 1024
+
+# Closing tags that get rewritten after every flush so the file on disk is always valid XML
+XML_TAIL = '\t</log>\n</sandbar>\n'
+
 class _LoggerSingleton:
     instance = None
 
@@ -12,6 +18,11 @@ class _LoggerSingleton:
         def __init__(self):
             self.initialized = False
             self.verbose = False
+            self.xmlFile = None
+            self.xmlBuffer = []
+            self.xmlBufferSize = 0
+            self.lastFlush = time.time()
+            atexit.register(self.close)
 
         def setup(self, logRoot, xmlFilePath, config, verbose=False):
             self.initialized = True
@@ -43,13 +54,22 @@ class _LoggerSingleton:
             self.logFilePath = os.path.join(self.logDir, xmlFilePath)
             if not os.path.exists(self.logDir):
                 os.makedirs(self.logDir)
-            self.logTree = ET.ElementTree(ET.Element("sandbar"))
 
-            # File exists. Delete it.
-            if os.path.isfile(self.logFilePath):
-                os.remove(self.logFilePath)
+            # Setting up again means starting a new file
+            self.close()
+
+            # The XML log is append-only: we write the head once and then stream message
+            # elements in just before the closing tags.
+            self.xmlFile = open(self.logFilePath, "wb")
+            self.xmlFile.write('<?xml version="1.0" ?>\n<sandbar>\n')
             if 'MetaData' in config:
-                obj2XML("MetaData", config, self.logTree.getroot())
+                metaRoot = ET.Element("sandbar")
+                obj2XML("MetaData", config, metaRoot)
+                for el in metaRoot:
+                    self.xmlFile.write('\t' + ET.tostring(el) + '\n')
+            self.xmlFile.write('\t<log>\n')
+            self.xmlTailPos = self.xmlFile.tell()
+            self.xmlPid = os.getpid()
             self.write()
 
         def logprint(self, message, method="", severity="info", exception=None):
@@ -97,26 +117,46 @@ class _LoggerSingleton:
 
 
             # Now print to XML
-            logNode = self.logTree.find("log")
-            if logNode is None:
-                logNode = ET.SubElement(self.logTree.getroot(), "log")
-
-            messageNode = ET.SubElement(logNode, "message", severity=severity, time=dateStr, method=method)
+            messageNode = ET.Element("message", severity=severity, time=dateStr, method=method)
             ET.SubElement(messageNode, "description").text = message
             if exception is not None:
                 ET.SubElement(messageNode, "exception").text = str(exception)
-            self.write()
+            xmlStr = '\t\t' + ET.tostring(messageNode) + '\n'
+            self.xmlBuffer.append(xmlStr)
+            self.xmlBufferSize += len(xmlStr)
+
+            # Errors go to disk straight away in case we're about to fall over
+            if severity in ['error', 'critical'] or self.xmlBufferSize >= XML_FLUSH_BYTES \
+                    or time.time() - self.lastFlush >= XML_FLUSH_SECONDS:
+                self.write()
 
         def write(self):
             """
-            Return a pretty-printed XML string for the Element.
+            Flush any buffered XML messages to disk. We only ever append: seek back over the
+            closing tags, write the new messages and put the closing tags back.
             """
-            rough_string = ET.tostring(self.logTree.getroot(), 'utf-8')
-            reparsed = minidom.parseString(rough_string)
-            pretty = reparsed.toprettyxml(indent="\t")
-            f = open(self.logFilePath, "wb")
-            f.write(pretty)
-            f.close()
+            # Forked worker processes inherit our file handle but they don't own it
+            if self.xmlFile is None or os.getpid() != self.xmlPid:
+                return
+            self.xmlFile.seek(self.xmlTailPos)
+            self.xmlFile.write(''.join(self.xmlBuffer))
+            self.xmlTailPos = self.xmlFile.tell()
+            self.xmlFile.write(XML_TAIL)
+            self.xmlFile.truncate()
+            self.xmlFile.flush()
+            self.xmlBuffer = []
+            self.xmlBufferSize = 0
+            self.lastFlush = time.time()
+
+        def close(self):
+            """
+            Flush whatever is left and close the XML file. Gets called at exit.
+            """
+            if self.xmlFile is None or os.getpid() != self.xmlPid:
+                return
+            self.write()
+            self.xmlFile.close()
+            self.xmlFile = None
 
     def __init__(self, **kwargs):
         if not _LoggerSingleton.instance:
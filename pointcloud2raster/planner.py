@@ -0,0 +1,229 @@
+import re
+import gdal
+from interpolators import Interpolator
+from rasterize import CHUNK_CELLS
+from raster import WRITE_BLOCK_CELLS
+
+# Rough peak bytes per point for each engine's search structures on top of the points
+# themselves. Measured on uniform random clouds (QHull's working set dominates the
+# triangulated methods).
+ENGINE_BYTES_PER_POINT = {
+    'linear': 850,
+    'cubic': 700,
+    'nearest': 48,
+    'idw': 48,
+}
+BINNING_BYTES_PER_POINT = 96
+
+# Bytes per cell of scratch while a block of cells is being evaluated
+EVALUATE_BYTES_PER_CELL = 64
+RASTERIZE_BYTES_PER_CELL = 160
+BINNING_BYTES_PER_CELL = 40
+
+# Tiles get their share of the points by area. Real clouds aren't uniform so allow for tiles
+# that are this many times denser than average.
+DENSITY_SLACK = 2.0
+
+# An interpreter with numpy, scipy and GDAL loaded, before it's done anything
+PROCESS_BYTES = 64 * 1024 * 1024
+
+# Tile sizes we'll try, biggest first
+TILE_SIZES = [4096, 2048, 1024, 512, 256, 128, 64]
+
+# Output types we'll try, best first. The raster is written as Float32 either way.
+DTYPES = ['float64', 'float32']
+
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+class ExecutionPlan(object):
+    """
+    How GridRaster is going to run (tile size, workers and output dtype) and what we think each
+    stage will cost in memory
+    """
+
+    def __init__(self, budget, tileSize, workers, dtype, stages):
+        """
+        :param budget: Memory we were given in bytes
+        :param tileSize: Tile size in cells or None for one pass
+        :param workers: Number of processes
+        :param dtype: 'float64' or 'float32' for the gridded values
+        :param stages: list of (stage name, bytes)
+        """
+        self.budget = budget
+        self.tileSize = tileSize
+        self.workers = workers
+        self.dtype = dtype
+        self.stages = stages
+        self.total = sum(size for name, size in stages)
+        self.fits = self.total <= budget
+
+    def describe(self):
+        """
+        :return: list of lines for the log
+        """
+        if self.tileSize is None:
+            how = "in one pass"
+        else:
+            how = "in tiles of {} cells using {} worker(s)".format(self.tileSize, self.workers)
+        lines = ["Memory plan: gridding {} with {} values. Estimated peak {} of {}".format(
+            how, self.dtype, FormatBytes(self.total), FormatBytes(self.budget))]
+        lines += ["    {:<14}{:>12}".format(name, FormatBytes(size)) for name, size in self.stages]
+        return lines
+
+    def report(self):
+        """
+        :return: dict for the profile report
+        """
+        return {'budget': self.budget, 'tileSize': self.tileSize, 'workers': self.workers, 'dtype': self.dtype,
+                'estimate': self.total, 'fits': self.fits, 'stages': dict(self.stages)}
+
+
+def PlanExecution(budget, npoints, grid, nvalues, method, workers=1, tileSize=None, halo=0, footprint='none',
+                  options=None, compact=False):
+    """
+    Pick the fastest way to run that we think fits in a memory budget.
+
+    Plans are tried in order of preference: keep every worker we were allowed, keep float64
+    values, keep the biggest tiles (or no tiles at all). The first one whose estimate fits wins.
+    If nothing does we hand back the leanest plan we've got and let the caller warn about it.
+
+    The estimates are deliberately simple (bytes per point and per cell for each stage) so treat
+    them as a guide, not a guarantee.
+
+    :param budget: Bytes we're allowed to use
+    :param npoints: Number of points being gridded
+    :param grid: The output Grid
+    :param nvalues: Number of value columns (bands)
+    :param method: Interpolation engine. One of the keys in interpolators.ENGINES
+    :param workers: Most processes we're allowed
+    :param tileSize: If given we stick to this tile size and only choose the rest
+    :param halo: Cells of neighbouring data each tile gets to see
+    :param footprint: Footprint method (see footprint.py)
+    :param options: dict of engine-specific settings (see interpolators.py)
+    :param compact: The points are CompactPoints (see compact.py) and the values are float32 throughout
+    :return: ExecutionPlan
+    """
+    workers = max(1, int(workers))
+    if tileSize is not None:
+        tileSizes = [tileSize]
+    else:
+        # Tiles as big as the grid are just one pass with extra steps
+        tileSizes = [None] + ([size for size in TILE_SIZES if size < max(grid.rows, grid.cols)] or TILE_SIZES[-1:])
+
+    plan = None
+    for nworkers in range(workers, 0, -1):
+        for dtype in (DTYPES[-1:] if compact else DTYPES):
+            for size in tileSizes:
+                # More than one worker only makes sense with tiles to hand out
+                if size is None and nworkers > 1:
+                    continue
+                plan = ExecutionPlan(budget, size, nworkers, dtype,
+                                     EstimateMemory(npoints, grid, nvalues, method, nworkers, size, halo, dtype,
+                                                    footprint, options, compact))
+                if plan.fits:
+                    return plan
+    return plan
+
+
+def EstimateMemory(npoints, grid, nvalues, method, workers=1, tileSize=None, halo=0, dtype='float64',
+                   footprint='none', options=None, compact=False):
+    """
+    Estimate the peak memory of each stage of a GridRaster run
+    :param npoints: Number of points
+    :param grid: The output Grid
+    :param nvalues: Number of value columns
+    :param method: Interpolation engine
+    :param workers: Number of processes (only used with tiles)
+    :param tileSize: Tile size in cells or None for one pass
+    :param halo: Halo in cells
+    :param dtype: 'float64' or 'float32' for the gridded values
+    :param footprint: Footprint method
+    :param options: dict of engine-specific settings
+    :param compact: The points are CompactPoints
+    :return: list of (stage name, bytes)
+    """
+    itemsize = 4 if dtype == 'float32' else 8
+    cells = grid.rows * grid.cols
+    binning = method not in ENGINE_BYTES_PER_POINT
+    engineBytes = BINNING_BYTES_PER_POINT if binning else ENGINE_BYTES_PER_POINT[method]
+    engineName = 'binning' if binning else 'kdtree' if method in ['nearest', 'idw'] else 'triangulation'
+
+    # Every process holds the loaded points (X, Y and values as float64, or int32 XY and float32
+    # values when they're compact)
+    pointBytes = (2 + nvalues) * 4 if compact else (2 + nvalues) * 8
+    loaded = npoints * pointBytes
+    # float64 XY copies the engine gets: the decoded XY and the origin-offset copy of them, or
+    # just the offsets for compact points
+    xyBytes = 2 * 8 * (1 if compact else 2)
+
+    if tileSize is None:
+        passPoints = npoints
+        passCells = cells
+        concurrent = 1
+        points = loaded + passPoints * xyBytes
+        # Whole raster plus the masked copy setArray makes and its mask
+        output = cells * nvalues * (2 * itemsize + 1)
+    else:
+        haloCells = (tileSize + 2 * halo) ** 2
+        passPoints = int(min(npoints, npoints * DENSITY_SLACK * haloCells / max(1, cells)))
+        passCells = min(cells, tileSize * tileSize)
+        concurrent = workers
+        # The parent's points and tile index, plus each tile's own copy of its points
+        points = loaded + npoints * 3 * 8 + concurrent * passPoints * (pointBytes + xyBytes)
+        # Tiles come back to the parent as they finish
+        output = (concurrent + 1) * passCells * nvalues * itemsize
+
+    if footprint != 'none':
+        # One mask for the whole grid, or one per tile being gridded
+        output += cells if tileSize is None else concurrent * passCells
+
+    engine = concurrent * passPoints * engineBytes
+    if footprint == 'alpha':
+        # The alpha footprint triangulates the points before the engine gets going (each tile
+        # only its own)
+        engine = max(engine, concurrent * passPoints * ENGINE_BYTES_PER_POINT['linear'])
+
+    if binning:
+        coordinates = concurrent * passCells * (BINNING_BYTES_PER_CELL + nvalues * 8)
+    elif method == 'linear':
+        coordinates = concurrent * min(passCells, CHUNK_CELLS) * RASTERIZE_BYTES_PER_CELL
+    else:
+        perCell = EVALUATE_BYTES_PER_CELL + nvalues * itemsize
+        if method == 'idw':
+            # Distances, indices, weights and neighbour values for every cell in the block
+            perCell += int((options or {}).get('k') or 12) * (3 + nvalues) * 8
+        coordinates = concurrent * min(passCells, Interpolator.BLOCK_CELLS) * perCell
+
+    # GDAL's block cache fills up as we write. One pass also fills in nodata a block at a time.
+    writeBuffer = gdal.GetCacheMax()
+    if tileSize is None:
+        writeBuffer += min(cells, WRITE_BLOCK_CELLS) * nvalues * itemsize
+    processes = PROCESS_BYTES * (1 + (workers if tileSize is not None and workers > 1 else 0))
+
+    return [('points', points), (engineName, engine), ('coordinates', coordinates), ('output', output),
+            ('writeBuffer', writeBuffer), ('processes', processes)]
+
+
+def ParseMemory(text):
+    """
+    Turn a memory size like 512M, 4G or 1.5GB into bytes. A plain number is bytes.
+    :param text:
+    :return: int
+    """
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)I?B?\s*$', str(text).upper())
+    if match is None:
+        raise ValueError("Can't understand memory size '{}'. Try something like 512M or 4G".format(text))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def FormatBytes(size):
+    """
+    :param size: bytes
+    :return: Human readable size
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
@@ -0,0 +1,114 @@
+import os
+import re
+import hashlib
+import numpy as np
+from loghelper import Logger
+from pointloader import LoadPoints, LoadCSVPoints, PointFormat
+
+# Sidecars live next to the CSV and look like: mycloud.csv.xyz1-2-3.<digest>.p2r.npy
+CACHE_SUFFIX = '.p2r.npy'
+
+# Hex characters of the key digest that go in the sidecar name
+DIGEST_LENGTH = 16
+
+CACHE_MODES = ['off', 'on', 'rebuild', 'purge']
+
+
+def LoadCachedPoints(sInputCSV, usecols, workers=1, mode='on'):
+    """
+    Load the selected columns of a point cloud, going through a binary sidecar cache.
+
+    The first time we see a file (for a given set of columns) we parse it and save the columns
+    as a .npy sidecar next to it. Every run after that memory-maps the sidecar instead of
+    parsing text. The sidecar is keyed on the file's path, size, mtime and the columns so
+    editing the CSV invalidates it.
+
+    :param sInputCSV: Path to the point cloud. Only text clouds get cached. Binary ones (LAS, .npy,
+                      .npz, Parquet) are loaded straight from the file
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :param workers: Number of processes to parse with on a cache miss
+    :param mode: One of 'off', 'on', 'rebuild' (throw away and recreate) or 'purge' (delete and don't cache)
+    :return: N x len(usecols) float64 array (an np.memmap on a cache hit)
+    """
+    log = Logger("PointCache")
+
+    if mode not in CACHE_MODES:
+        raise ValueError("Unknown cache mode '{}'. Must be one of {}".format(mode, ', '.join(CACHE_MODES)))
+
+    # Binary formats load about as fast as the sidecar would so there's nothing to cache
+    if mode == 'off' or PointFormat(sInputCSV) != 'csv':
+        return LoadPoints(sInputCSV, usecols, workers=workers)
+
+    if mode in ['rebuild', 'purge']:
+        PurgeCache(sInputCSV)
+        if mode == 'purge':
+            return LoadCSVPoints(sInputCSV, usecols, workers=workers)
+
+    sCachePath = CachePath(sInputCSV, usecols)
+    if os.path.isfile(sCachePath):
+        log.info("Using point cache: {}".format(sCachePath))
+        return np.load(sCachePath, mmap_mode='r')
+
+    data = LoadCSVPoints(sInputCSV, usecols, workers=workers)
+
+    # Anything left over for these columns is from an older version of the file
+    PurgeCache(sInputCSV, usecols)
+
+    try:
+        tmpPath = sCachePath + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            np.save(f, np.ascontiguousarray(data))
+        os.rename(tmpPath, sCachePath)
+        log.info("Point cache written: {}".format(sCachePath))
+    except (IOError, OSError) as e:
+        # A read-only folder shouldn't stop us from gridding
+        log.warning("Could not write point cache {}".format(sCachePath), e)
+        return data
+
+    return np.load(sCachePath, mmap_mode='r')
+
+
+def CachePath(sInputCSV, usecols):
+    """
+    Work out the sidecar path for a file and set of columns
+    :param sInputCSV:
+    :param usecols: Zero-indexed column numbers
+    :return:
+    """
+    stat = os.stat(sInputCSV)
+    key = '|'.join([os.path.abspath(sInputCSV), str(stat.st_size), repr(stat.st_mtime), _columnTag(usecols)])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:DIGEST_LENGTH]
+    return '{}.{}.{}{}'.format(sInputCSV, _columnTag(usecols), digest, CACHE_SUFFIX)
+
+
+def PurgeCache(sInputCSV, usecols=None):
+    """
+    Delete cache sidecars belonging to a file
+    :param sInputCSV:
+    :param usecols: Only delete sidecars for these columns. None means all of them
+    :return: The number of files removed
+    """
+    log = Logger("PointCache")
+    folder = os.path.dirname(os.path.abspath(sInputCSV))
+    # Exactly what CachePath makes so we leave other files' sidecars alone (a.csv.bak.csv's
+    # sidecars start with "a.csv." too)
+    columns = re.escape(_columnTag(usecols)) if usecols is not None else r'xyz\d+(-\d+)*'
+    pattern = re.compile(r'^{}\.{}\.[0-9a-f]{{{}}}{}$'.format(re.escape(os.path.basename(sInputCSV)), columns,
+                                                         DIGEST_LENGTH, re.escape(CACHE_SUFFIX)))
+
+    removed = 0
+    for filename in os.listdir(folder):
+        if pattern.match(filename):
+            os.remove(os.path.join(folder, filename))
+            log.debug("Removed point cache: {}".format(filename))
+            removed += 1
+    return removed
+
+
+def _columnTag(usecols):
+    """
+    A readable tag for the columns, using the same 1-indexed numbers as the command line
+    :param usecols:
+    :return:
+    """
+    return 'xyz' + '-'.join(str(col + 1) for col in usecols)
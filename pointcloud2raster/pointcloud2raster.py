@@ -1,45 +1,118 @@
 import sys
+import copy
 import argparse
 from loghelper import Logger
 import numpy as np
-from scipy.interpolate import LinearNDInterpolator
-from scipy.spatial import Delaunay
 import gdal
 import math
-from raster import Raster
+from raster import Raster, CreationOptions, COMPRESSION, BIGTIFF
+from pointcache import LoadCachedPoints, CACHE_MODES
+from grid import Grid
+from interpolators import CreateInterpolator, PointValues, ENGINES
+from tiling import GridTiles, DEFAULT_HALO, DEFAULT_TILESIZE
+from footprint import Footprint, TiledFootprint, FOOTPRINTS
+from thinning import ThinPoints, THINNING
+from planner import PlanExecution, ParseMemory, FormatBytes
+from compact import CompactPoints, PRECISIONS, DEFAULT_QUANTUM
+from provenance import TouchedTiles, SourceRecord, WriteProvenance
+from profiler import Profiler
 gdal.UseExceptions()
 
-def GridRaster(sInputCSV, sOutputRaster, cellsize, xfield, yfield, zfield, method, templateRaster):
+def GridRaster(sInputCSV, sOutputRaster, cellsize, xfield, yfield, zfield, method, templateRaster, workers=1, cache='off',
+               tileSize=None, halo=DEFAULT_HALO, options=None, creationOptions=None, profile=None, footprint='none',
+               alpha=None, thin='none', thinKeep=1, maxMemory=None, precision='double', quantum=DEFAULT_QUANTUM,
+               provenance=False):
     """
     :param gdalWarpPath:
     :param sInputCSV:
     :param sOutputRaster:
-    :return:
+    :param zfield: Column number for Z, or a list of them. Each Z column becomes a band of the output
+                   and they all share one triangulation (or KD-tree etc.)
+    :param method: Interpolation engine. One of the keys in interpolators.ENGINES
+    :param templateRaster: Path to a raster to copy the cell size and projection from, or a Raster
+                           that's already been opened (it won't be changed)
+    :param workers: Number of processes to use for the parallel stages
+    :param cache: Point cache mode. One of 'off', 'on', 'rebuild', 'purge'
+    :param tileSize: Grid in square tiles this many cells wide to bound memory. None means one pass
+                     (unless workers > 1, then we default to DEFAULT_TILESIZE)
+    :param halo: Number of cells of neighbouring data each tile gets to see
+    :param options: dict of engine-specific settings (see interpolators.py)
+    :param creationOptions: GeoTIFF creation options for the output (see raster.CreationOptions)
+    :param profile: Path to write a JSON report of time and memory for each stage
+    :param footprint: Only grid cells inside the data's footprint. One of 'none', 'hull' or 'alpha'
+                      (see footprint.py). Everything outside it is nodata
+    :param alpha: Longest triangle edge (map units) for the alpha footprint
+    :param thin: Thin the points per output cell before gridding. One of 'none', 'keep', 'centroid'
+                 or 'minmax' (see thinning.py)
+    :param thinKeep: Points per cell for the 'keep' thinning
+    :param maxMemory: Memory budget in bytes. If given we estimate what every stage is going to
+                      need and choose the tile size, number of workers (no more than we were
+                      given) and output dtype to fit (see planner.py)
+    :param precision: 'double' keeps everything float64. 'compact' stores X and Y as int32 steps of
+                      quantum from the middle of the data and the values as float32, and grids
+                      into float32 (see compact.py)
+    :param quantum: XY step in map units for compact precision
+    :param provenance: Write a sidecar next to the output with the settings and which tiles each input
+                       touched so pointcloud2raster-update can patch the raster later (see provenance.py)
+    :return: The profiler report (see profiler.py). Counts and overall time are always there, the
+             stage details only when profile is given
     """
 
     # Read Raster Properties
     Log = Logger("GridRaster")
+
+    if method not in ENGINES:
+        raise ValueError("Unknown method '{}'. Must be one of {}".format(method, ', '.join(sorted(ENGINES))))
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '{}'. Must be one of {}".format(precision, ', '.join(PRECISIONS)))
+    if thin == 'keep' and thinKeep < 1:
+        raise ValueError("--thinkeep has to be at least 1, not {}".format(thinKeep))
+
+    zfields = list(zfield) if isinstance(zfield, (list, tuple)) else [zfield]
+
+    profiler = Profiler(enabled=profile is not None)
+    profiler.info = {'input': sInputCSV, 'output': sOutputRaster, 'method': method, 'workers': workers,
+                     'tileSize': tileSize, 'halo': halo, 'cache': cache, 'zfields': zfields,
+                     'footprint': footprint, 'alpha': alpha, 'thin': thin, 'thinKeep': thinKeep,
+                     'maxMemory': maxMemory, 'precision': precision, 'quantum': quantum}
+
     Log.info("Loading Data...")
+    with profiler.stage("Loading Data") as counts:
+        # Don't forget to zero-offset the indeces for the columns
+        usecols = (xfield-1, yfield-1) + tuple(z-1 for z in zfields)
+        my_data = LoadCachedPoints(sInputCSV, usecols, workers=workers, mode=cache)
+        counts['points'] = my_data.shape[0]
+    profiler.count('points', my_data.shape[0])
 
-    # Don't forget to zero-offset the indeces for the columns
-    my_data = np.genfromtxt(sInputCSV, delimiter=' ', usecols=(xfield-1,yfield-1,zfield-1))
+    compact = precision == 'compact'
+    if compact:
+        Log.info("Compacting points...")
+        with profiler.stage("Compacting Points", points=my_data.shape[0]):
+            my_data = CompactPoints.fromArray(my_data, quantum)
+        # Values come out of the engines as float32 too
+        options = dict(options or {}, dtype='float32')
 
     Log.info("Getting data extents...")
-    # We poll the data for the minimum extents of all the columsn.
-    # This gives us our rectangle
-    raw_max_x, raw_max_y, max_z = np.amax(my_data, axis=0)
-    raw_min_x, raw_min_y, min_z = np.amin(my_data, axis=0)
+    with profiler.stage("Getting data extents", points=my_data.shape[0]):
+        # We poll the data for the minimum extents of all the columsn.
+        # This gives us our rectangle
+        if compact:
+            raw_min_x, raw_max_x, raw_min_y, raw_max_y = my_data.extent()
+        else:
+            raw_max_x, raw_max_y = np.amax(my_data[:, :2], axis=0)
+            raw_min_x, raw_min_y = np.amin(my_data[:, :2], axis=0)
 
     # If the user passed in a template raster then pattern ours off of it.
-    if templateRaster is not None:
+    if isinstance(templateRaster, Raster):
+        # Already open (batch mode shares one between jobs). Take a copy so we don't move it
+        raster = copy.copy(templateRaster)
+    elif templateRaster is not None:
         raster = Raster(filepath=templateRaster)
-        cw = raster.cellWidth
-        ch = raster.cellHeight
     # otherwise we'll need to build a raster from scratch without a CRS
     else:
         raster = Raster(cellWidth=cellsize)
-        cw = cellsize
-        ch = cellsize
+    cw = raster.cellWidth
+    ch = raster.cellHeight
 
     # Calculate the rectangle encompassing all our data by cropping to the nearest cell outside our data's extents
     top = math.ceil( raw_max_y / abs(ch) ) * abs(ch)
@@ -48,11 +121,36 @@ def GridRaster(sInputCSV, sOutputRaster, cellsize, xfield, yfield, zfield, metho
     left = math.floor(raw_min_x / cw) * cw
     right = math.ceil(raw_max_x / cw) * cw
 
-    # Here's where we create an array of dimension 2 X Rows X Cols
-    # It's basically two grids, one that contains top -> bottom coordinates (y) and the other that contains left to
-    # right coordinates (x) using the cell height (ch) and cell width (cw) as an increment
+    # This is the shape of our output: Rows X Cols cells using the cell height (ch) and cell width (cw)
+    # as an increment from the top left corner
     Log.info("Setting up new Axes...")
-    newAxes = np.mgrid[ top:bottom:ch, left:right:cw ]
+    grid = Grid.fromExtent(left, right, top, bottom, cw, ch)
+    profiler.count('cells', grid.rows * grid.cols)
+
+    if thin != 'none':
+        Log.info("Thinning points ({})...".format(thin))
+        with profiler.stage("Thinning", points=my_data.shape[0]):
+            thinned = ThinPoints(my_data, grid, thin, thinKeep)
+            # Centroids are new points so they come back as a plain array
+            if compact and not isinstance(thinned, CompactPoints):
+                thinned = CompactPoints.fromArray(thinned, my_data.quantum, my_data.origin)
+            my_data = thinned
+        profiler.count('thinnedPoints', my_data.shape[0])
+        Log.info("Thinned to {} points".format(my_data.shape[0]))
+
+    # Now we know how many points and cells there are we can work out how to stay inside the budget
+    if maxMemory is not None:
+        plan = PlanExecution(maxMemory, my_data.shape[0], grid, len(zfields), method, workers, tileSize, halo,
+                             footprint, options, compact)
+        for line in plan.describe():
+            Log.info(line)
+        if not plan.fits:
+            Log.warning("Even the leanest plan needs about {} so this may run out of memory".format(
+                FormatBytes(plan.total)))
+        tileSize = plan.tileSize
+        workers = plan.workers
+        options = dict(options or {}, dtype=plan.dtype)
+        profiler.info['plan'] = plan.report()
 
     # Grid data. The first parameter is a double list containing the X and Y columns of the CSV.
     # The second parameter is just the Z values from the CSV
@@ -63,45 +161,105 @@ def GridRaster(sInputCSV, sOutputRaster, cellsize, xfield, yfield, zfield, metho
     # We need to center the points around the origin so that QHull doesn't freak out.
     # -------------------------------------------------
     # https://stackoverflow.com/questions/30868399/how-to-include-all-points-into-error-less-triangulation-mesh-with-scipy-spatial
-    points = my_data[:, [0, 1]]
-    origin_offset = points.mean(axis=0)
-
-    # QHull option QJ ensures we don't throw away any points
-    Log.info("Creating Delaunay Triangles...")
-    tri = Delaunay(points-origin_offset, qhull_options="QJ")
+    # Compact points already sit around their own origin
+    origin_offset = my_data.origin if compact else my_data[:, [0, 1]].mean(axis=0)
 
-    Log.info("Creating Interpolator...")
-    interpolationfunction = LinearNDInterpolator(tri, my_data[:, 2], fill_value=np.nan)
+    # Workers need tiles to work on
+    if workers > 1 and tileSize is None:
+        tileSize = DEFAULT_TILESIZE
 
-    # Now we have our interpolation function. Throw a grid of XY coords at it (not forgetting to offset)
-    Log.info("Interpolating Points...")
-    newArray = interpolationfunction((newAxes[1] - origin_offset[0] + cw/2,
-                                      newAxes[0] - origin_offset[1] + ch/2))
-
-    Log.info("Writing Output Raster...")
+    # Cells outside the footprint don't get handed to the engine and end up as nodata. Tiles work
+    # out their own so we never need a mask of the whole grid or to triangulate the whole cloud.
+    mask = None
+    tileFootprint = None
+    if footprint != 'none':
+        Log.info("Working out the {} footprint...".format(footprint))
+        with profiler.stage("Footprint", points=my_data.shape[0]):
+            if tileSize is None:
+                xy = my_data.offsetXY() if compact else my_data[:, [0, 1]] - origin_offset
+                mask = Footprint(xy, grid, origin_offset, footprint, alpha,
+                                 tricache=(options or {}).get('tricache'))
+                del xy
+            else:
+                tileFootprint = TiledFootprint(my_data, grid, origin_offset, footprint, alpha,
+                                               tricache=(options or {}).get('tricache'))
+        if mask is not None:
+            Log.info("Footprint covers {} of {} cells".format(int(mask.sum()), mask.size))
 
     # Our top and left may not match the template raster so make sure to set those explicitly
     raster.top = top
     raster.left = left
+    raster.bands = len(zfields)
+    if creationOptions is not None:
+        raster.options = creationOptions
+
+    if tileSize is None:
+        # One pass means the engine is free to use every worker we've got
+        options = dict(options or {}, threads=workers)
+        with profiler.stage("Creating Interpolator", points=my_data.shape[0]):
+            # Compact points hand over their offsets directly rather than decoding to absolute
+            # coordinates and then taking the origin back off (two full float64 copies)
+            if compact:
+                interpolationfunction = CreateInterpolator(my_data.offsetXY(), PointValues(my_data), origin_offset,
+                                                           method, log=Log, options=options, offset=False)
+            else:
+                interpolationfunction = CreateInterpolator(my_data[:, [0, 1]], PointValues(my_data), origin_offset,
+                                                           method, log=Log, options=options)
+
+        # Now we have our interpolation function. Throw a grid of XY coords at it (not forgetting to offset)
+        Log.info("Interpolating Points...")
+        with profiler.stage("Interpolating Points", cells=grid.rows * grid.cols):
+            if interpolationfunction is not None:
+                newArray = interpolationfunction.interpolate(grid, origin_offset, mask)
+            else:
+                Log.warning("Not enough points for the {} method. Output will be empty".format(method))
+                newArray = np.full((grid.rows, grid.cols) + PointValues(my_data).shape[1:], np.nan,
+                                   dtype=options.get('dtype'))
+
+        Log.info("Writing Output Raster...")
+        with profiler.stage("Writing Output Raster", cells=grid.rows * grid.cols):
+            # Set the array and write the file to disk
+            raster.setArray(newArray)
+            raster.write(sOutputRaster)
+    else:
+        # Tiled mode: every tile gets written to disk as soon as it's done
+        Log.info("Gridding {} x {} cells in tiles of {} cells with a halo of {}...".format(grid.cols, grid.rows, tileSize, halo))
+        with profiler.stage("Gridding Tiles", points=my_data.shape[0], cells=grid.rows * grid.cols):
+            raster.rows = grid.rows
+            raster.cols = grid.cols
+            raster.create(sOutputRaster)
+            GridTiles(my_data, grid, raster, tileSize, halo, origin_offset, method, workers=workers, options=options,
+                      footprint=tileFootprint)
+            raster.close()
 
-    # Set the array and write the file to disk
-    raster.setArray(newArray)
-    raster.write(sOutputRaster)
+    if provenance:
+        with profiler.stage("Provenance", points=my_data.shape[0]):
+            # A one pass run still gets carved into tiles so an update has something to re-grid
+            provTileSize = tileSize or DEFAULT_TILESIZE
+            settings = {'xfield': xfield, 'yfield': yfield, 'zfields': zfields, 'method': method, 'halo': halo,
+                        'footprint': footprint, 'alpha': alpha, 'thin': thin, 'thinKeep': thinKeep,
+                        'precision': precision, 'quantum': quantum,
+                        'options': dict((key, value) for key, value in (options or {}).items()
+                                        if key in ['power', 'k', 'radius', 'dtype'])}
+            WriteProvenance(sOutputRaster, grid, provTileSize, origin_offset, settings,
+                            [SourceRecord(sInputCSV, sOutputRaster, profiler.counts['points'],
+                                          TouchedTiles(my_data, grid, provTileSize, halo))])
 
     Log.info("Done. Output file written: {}".format(sOutputRaster))
 
+    if profile is not None:
+        profiler.write(profile)
+        Log.info("Profile report written: {}".format(profile))
 
-def main():
-    #parse command line options
-    parser = argparse.ArgumentParser()
-    parser.add_argument('csvfile',
-                        help = 'Path to the input CSV pointcloud file.',
-                        type = argparse.FileType('r'))
+    return profiler.report()
 
-    parser.add_argument('outputRaster',
-                        help = 'Path to the desired output Raster file.',
-                        type = str)
 
+def AddGriddingArguments(parser):
+    """
+    Add the command line options that control the gridding. Batch mode shares these.
+    :param parser: argparse.ArgumentParser
+    :return:
+    """
     parser.add_argument('--cellsize',
                         help = 'Cell size to use. Use this if not a templateraster',
                         type = float)
@@ -117,17 +275,176 @@ def main():
                         type = int)
 
     parser.add_argument('--zfield',
-                        help='column number to use for Z (defaults to 3)',
-                        default=3,
+                        help='column number to use for Z (defaults to 3). Give more than one to get a band for each',
+                        default=[3],
+                        nargs='+',
                         type=int)
 
     parser.add_argument('--method',
-                        help='Method for griddata. One of "cubic", "linear", "nearest" Default: linear',
+                        help='Method for griddata. One of "cubic", "linear", "nearest", "idw" or a per-cell statistic of the '
+                             'points in each cell: "mean", "min", "max", "count", "stdev", "median" Default: linear',
                         default="linear",
+                        choices=sorted(ENGINES),
                         type=str)
+    parser.add_argument('--idwpower',
+                        help='Distance exponent for the idw method (defaults to 2)',
+                        default=2.0,
+                        type=float)
+    parser.add_argument('--idwneighbours',
+                        help='Maximum number of nearest points the idw method uses (defaults to 12)',
+                        default=12,
+                        type=int)
+    parser.add_argument('--idwradius',
+                        help='Search radius for the idw method in map units. Cells with nothing inside it are nodata',
+                        type=float)
+    parser.add_argument('--tricache',
+                        help='Folder to keep Delaunay triangulations in. Re-gridding the same XY with the linear '
+                             'method reuses them instead of triangulating again',
+                        type=str)
+    parser.add_argument('--footprint',
+                        help='Only grid cells inside the convex "hull" of the points or their "alpha" shape '
+                             '(triangles with no edge longer than --alpha). Everything else is nodata. Default: none',
+                        default='none',
+                        choices=FOOTPRINTS,
+                        type=str)
+    parser.add_argument('--alpha',
+                        help='Longest triangle edge in map units for --footprint alpha (defaults to 5 cells)',
+                        type=float)
+    parser.add_argument('--thin',
+                        help='Thin the points in each cell before gridding: "keep" the first few, replace them with '
+                             'their "centroid" or keep the "minmax" values. Default: none',
+                        default='none',
+                        choices=THINNING,
+                        type=str)
+    parser.add_argument('--thinkeep',
+                        help='Points to keep in each cell for --thin keep (defaults to 1)',
+                        default=1,
+                        type=int)
     parser.add_argument('--templateraster',
                         help='Template Raster to use for meta values',
                         type=argparse.FileType('r'))
+    parser.add_argument('--workers',
+                        help='Number of processes to use for loading and gridding (defaults to 1)',
+                        default=1,
+                        type=int)
+    parser.add_argument('--cache',
+                        help='Binary point cache next to the CSV. One of "off", "on", "rebuild", "purge" Default: off',
+                        default='off',
+                        choices=CACHE_MODES,
+                        type=str)
+    parser.add_argument('--tilesize',
+                        help='Grid in square tiles this many cells wide so memory is bounded by the tile size',
+                        type=int)
+    parser.add_argument('--maxmemory', '--max-memory',
+                        help='Memory budget like 512M or 4G. The tile size, number of workers (up to --workers) and '
+                             'output precision get chosen to fit and the plan is logged before gridding starts',
+                        dest='maxmemory',
+                        type=ParseMemory)
+    parser.add_argument('--precision',
+                        help='"compact" keeps X and Y as int32 steps of --quantum and Z as float32 and grids into '
+                             'float32. About half the memory of "double" (the default)',
+                        default='double',
+                        choices=PRECISIONS,
+                        type=str)
+    parser.add_argument('--quantum',
+                        help='XY step in map units for --precision compact (defaults to {})'.format(DEFAULT_QUANTUM),
+                        default=DEFAULT_QUANTUM,
+                        type=float)
+    parser.add_argument('--halo',
+                        help='Number of cells of neighbouring data each tile uses (defaults to {})'.format(DEFAULT_HALO),
+                        default=DEFAULT_HALO,
+                        type=int)
+    parser.add_argument('--provenance',
+                        help='Write a .p2r.json sidecar next to the output recording the settings and which tiles '
+                             'each input touched so pointcloud2raster-update can patch it later',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--compress',
+                        help='Output compression (defaults to LZW)',
+                        default='LZW',
+                        choices=COMPRESSION,
+                        type=str)
+    parser.add_argument('--predictor',
+                        help='Compression predictor. 2 is horizontal differencing, 3 is floating point',
+                        choices=[1, 2, 3],
+                        type=int)
+    parser.add_argument('--tiled',
+                        help='Write a tiled GeoTIFF instead of strips',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--blocksize',
+                        help='Internal tile size in cells for --tiled output (defaults to 256)',
+                        default=256,
+                        type=int)
+    parser.add_argument('--bigtiff',
+                        help='When to write a BigTIFF (defaults to IF_SAFER)',
+                        default='IF_SAFER',
+                        choices=BIGTIFF,
+                        type=str)
+
+
+def GriddingArguments(args):
+    """
+    Turn the parsed options from AddGriddingArguments into keyword arguments for GridRaster
+    :param args: argparse namespace
+    :return: dict
+    """
+    templateRaster = None
+    if args.templateraster:
+        templateRaster = args.templateraster.name
+
+    options = {
+        'power': args.idwpower,
+        'k': args.idwneighbours,
+        'radius': args.idwradius,
+        'tricache': args.tricache,
+    }
+
+    creationOptions = CreationOptions(compress=args.compress, tiled=args.tiled, blockSize=args.blocksize,
+                                      bigtiff=args.bigtiff, predictor=args.predictor)
+
+    return {
+        'cellsize': args.cellsize,
+        'xfield': args.xfield,
+        'yfield': args.yfield,
+        'zfield': args.zfield,
+        'method': args.method,
+        'templateRaster': templateRaster,
+        'workers': args.workers,
+        'cache': args.cache,
+        'tileSize': args.tilesize,
+        'halo': args.halo,
+        'options': options,
+        'creationOptions': creationOptions,
+        'footprint': args.footprint,
+        'alpha': args.alpha,
+        'thin': args.thin,
+        'thinKeep': args.thinkeep,
+        'maxMemory': args.maxmemory,
+        'precision': args.precision,
+        'quantum': args.quantum,
+        'provenance': args.provenance,
+    }
+
+
+def main():
+    #parse command line options
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csvfile',
+                        help = 'Path to the input pointcloud file. Space-delimited CSV, LAS (1.0 - 1.4, uncompressed), '
+                               'NumPy .npy/.npz or Parquet (needs pyarrow). '
+                               'For LAS the columns are 1 X, 2 Y, 3 Z, 4 intensity, 5 classification, 6 GPS time',
+                        type = argparse.FileType('r'))
+
+    parser.add_argument('outputRaster',
+                        help = 'Path to the desired output Raster file.',
+                        type = str)
+
+    AddGriddingArguments(parser)
+
+    parser.add_argument('--profile',
+                        help='Write a JSON report of the time and memory each stage took to this file',
+                        type=str)
     parser.add_argument('--verbose',
                         help = 'Get more information in your logs.',
                         action='store_true',
@@ -137,12 +454,8 @@ def main():
     log = Logger("Program")
 
     try:
-        templateRaster = None
-        if args.templateraster:
-            templateRaster = args.templateraster.name
-
         # Now kick things off
-        GridRaster(args.csvfile.name, args.outputRaster, args.cellsize, args.xfield, args.yfield, args.zfield, args.method, templateRaster)
+        GridRaster(args.csvfile.name, args.outputRaster, profile=args.profile, **GriddingArguments(args))
     except AssertionError as e:
         log.error("Assertion Error", e)
         sys.exit(0)
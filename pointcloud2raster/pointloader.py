@@ -0,0 +1,248 @@
+import os
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from io import BytesIO
+import numpy as np
+from loghelper import Logger
+from lasreader import IsLAS, LoadLASPoints
+from tablereader import TableFormat, LoadNPYPoints, LoadNPZPoints, LoadParquetPoints
+
+# Each worker reads its byte range into memory in one go so we cap the size of a range
+# to keep the per-process footprint predictable on very large files.
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Below this it's not worth the cost of spinning up a process pool
+MIN_PARALLEL_BYTES = 8 * 1024 * 1024
+
+# The output array the parser writes into. In a worker process this gets set by _initWorker
+_sharedArray = None
+
+
+def PointFormat(sInput):
+    """
+    Work out what kind of point cloud a file is from its contents (not its extension)
+    :param sInput:
+    :return: 'las', 'npy', 'npz', 'parquet' or 'csv'
+    """
+    if IsLAS(sInput):
+        return 'las'
+    return TableFormat(sInput) or 'csv'
+
+
+def LoadPoints(sInput, usecols, workers=1):
+    """
+    Load the selected columns of a point cloud in any format we can read
+    :param sInput: Path to the point cloud
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :param workers: Number of processes to parse text with
+    :return: N x len(usecols) float64 array
+    """
+    pointFormat = PointFormat(sInput)
+    if pointFormat == 'las':
+        return LoadLASPoints(sInput, usecols)
+    if pointFormat == 'npy':
+        return LoadNPYPoints(sInput, usecols)
+    if pointFormat == 'npz':
+        return LoadNPZPoints(sInput, usecols)
+    if pointFormat == 'parquet':
+        return LoadParquetPoints(sInput, usecols)
+    return LoadCSVPoints(sInput, usecols, workers=workers)
+
+
+def LoadCSVPoints(sInputCSV, usecols, workers=1):
+    """
+    Load the selected columns of a space-delimited point cloud into a single float array.
+
+    The file gets split into byte ranges that start and end on line boundaries. We count the
+    lines in each range first so we can preallocate one output array, then every range is
+    parsed (in parallel if workers > 1) straight into its own rows of that array.
+
+    Parsing uses numpy's C tokenizer. Any range that doesn't parse cleanly (headers, comments,
+    blank lines, double spaces etc.) falls back to np.genfromtxt so we keep the exact same
+    delimiter=' ' semantics we've always had.
+
+    :param sInputCSV: Path to the space-delimited point cloud
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :param workers: Number of processes to parse with
+    :return: N x len(usecols) float64 array
+    """
+    log = Logger("LoadCSVPoints")
+    usecols = tuple(usecols)
+
+    ncols = _countColumns(sInputCSV)
+    if ncols == 0:
+        raise ValueError("No data found in {}".format(sInputCSV))
+    if max(usecols) >= ncols:
+        raise ValueError("Column {} requested but {} only has {} columns".format(max(usecols) + 1, sInputCSV, ncols))
+
+    size = os.path.getsize(sInputCSV)
+    workers = max(1, int(workers))
+    if size < MIN_PARALLEL_BYTES:
+        workers = 1
+    nranges = max(workers, int(size // CHUNK_BYTES) + 1)
+    ranges = _byteRanges(sInputCSV, nranges)
+    log.debug("Parsing {} bytes in {} ranges using {} worker(s)".format(size, len(ranges), workers))
+
+    # Pass 1: count lines so we know where each range lands in the output
+    tasks = [(sInputCSV, start, end) for start, end in ranges]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        counts = pool.map(_countLines, tasks)
+        pool.close()
+        pool.join()
+    else:
+        counts = [_countLines(task) for task in tasks]
+
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    totalLines = int(offsets[-1])
+
+    # Pass 2: parse every range into its slice of one preallocated array
+    tasks = [(sInputCSV, start, end, int(offsets[idx]), ncols, usecols) for idx, (start, end) in enumerate(ranges)]
+    if workers > 1:
+        raw = RawArray('d', max(1, totalLines * len(usecols)))
+        pool = multiprocessing.Pool(workers, initializer=_initWorker, initargs=(raw, len(usecols)))
+        parsed = pool.map(_parseRange, tasks)
+        pool.close()
+        pool.join()
+        data = np.frombuffer(raw, dtype=np.float64)[:totalLines * len(usecols)].reshape(-1, len(usecols))
+    else:
+        data = np.empty((totalLines, len(usecols)), dtype=np.float64)
+        _initWorker(data, len(usecols))
+        parsed = [_parseRange(task) for task in tasks]
+        _initWorker(None, len(usecols))
+
+    # Lines that don't hold data (blank lines, comments) leave gaps at the end of their ranges.
+    # Shuffle everything down so the rows are contiguous.
+    total = 0
+    for idx, nrows in enumerate(parsed):
+        if total != offsets[idx]:
+            data[total:total + nrows] = data[offsets[idx]:offsets[idx] + nrows]
+        total += nrows
+
+    return data[:total]
+
+
+def _countColumns(sInputCSV):
+    """
+    Number of space-delimited fields on the first line that holds data
+    :param sInputCSV:
+    :return:
+    """
+    with open(sInputCSV, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if len(line.strip()) == 0 or line.lstrip().startswith(b'#'):
+                continue
+            return len(line.split(b' '))
+    return 0
+
+
+def _byteRanges(sInputCSV, nranges):
+    """
+    Split a file into (start, end) byte ranges that begin and end on line boundaries
+    :param sInputCSV:
+    :param nranges:
+    :return:
+    """
+    size = os.path.getsize(sInputCSV)
+    bounds = [0]
+    with open(sInputCSV, 'rb') as f:
+        for idx in range(1, nranges):
+            pos = max(size * idx // nranges, bounds[-1])
+            if pos == 0 or pos >= size:
+                continue
+            # Back up one byte and finish whatever line we landed in
+            f.seek(pos - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _countLines(task):
+    """
+    Count the lines in a byte range. A final line without a newline still counts.
+    :param task: (path, start, end)
+    :return:
+    """
+    sInputCSV, start, end = task
+    count = 0
+    last = b'\n'
+    with open(sInputCSV, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(remaining, 16 * 1024 * 1024))
+            if not block:
+                break
+            count += block.count(b'\n')
+            last = block[-1:]
+            remaining -= len(block)
+    if last != b'\n':
+        count += 1
+    return count
+
+
+def _initWorker(shared, width):
+    """
+    Point the parser at the output array. Called once in each worker process.
+    :param shared: RawArray (in a worker) or numpy array (in-process)
+    :param width: number of output columns
+    :return:
+    """
+    global _sharedArray
+    if shared is None or isinstance(shared, np.ndarray):
+        _sharedArray = shared
+    else:
+        _sharedArray = np.frombuffer(shared, dtype=np.float64).reshape(-1, width)
+
+
+def _parseRange(task):
+    """
+    Parse one byte range into its rows of the shared output array
+    :param task: (path, start, end, rowoffset, ncols, usecols)
+    :return: The number of data rows actually written
+    """
+    sInputCSV, start, end, rowoffset, ncols, usecols = task
+    with open(sInputCSV, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start)
+
+    nlines = text.count(b'\n') + (0 if text.endswith(b'\n') else 1)
+
+    # Fast path: let numpy's C parser tokenize the whole block. If every line has exactly ncols
+    # numbers in it we get a perfect rectangle. Just checking the total isn't enough: a short
+    # line and a long one would still add up and shift values into the wrong rows.
+    flat = np.fromstring(text, dtype=np.float64, sep=' ')
+    if flat.size == nlines * ncols and _regularLines(text, nlines, ncols):
+        rows = flat.reshape(nlines, ncols)[:, usecols]
+    else:
+        # Something irregular in here. Let genfromtxt deal with it the way it always has.
+        rows = np.genfromtxt(BytesIO(text), delimiter=' ', usecols=usecols)
+        rows = rows.reshape(-1, len(usecols))
+
+    _sharedArray[rowoffset:rowoffset + rows.shape[0]] = rows
+    return rows.shape[0]
+
+
+
+def _regularLines(text, nlines, ncols):
+    """
+    Check every line of a block of text has exactly ncols whitespace-separated fields. Assumes
+    the block has nlines * ncols fields altogether.
+    :param text: bytes
+    :param nlines: Number of lines in it
+    :param ncols:
+    :return: True if it's a perfect rectangle
+    """
+    buf = np.frombuffer(text, dtype=np.uint8)
+    # Spaces, tabs, CRs and newlines are all <= ' '. A field starts wherever something else
+    # follows one of them (or the start of the block)
+    space = buf <= ord(' ')
+    fieldStarts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    del space
+    newlines = np.flatnonzero(buf == ord('\n'))[:nlines - 1]
+    # With the right total, line k has ncols fields if its first field (k * ncols) comes after
+    # the newline before it and its last field comes before the newline after it
+    return bool((fieldStarts[ncols::ncols] > newlines).all() and
+                (fieldStarts[ncols - 1::ncols][:len(newlines)] < newlines).all())
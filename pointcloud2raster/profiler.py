@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import json
+from contextlib import contextmanager
+
+# Not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Python 3.4+ only
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Profiler(object):
+    """
+    Records wall time, CPU time and memory use for each named stage of a run, plus whatever
+    counts (points, cells...) the caller gives us so we can work out throughput.
+
+    Each stage gets the counts it actually works through and its throughput is only those. Counts
+    for the whole run go through count() and get divided by the total time.
+
+        profiler = Profiler()
+        with profiler.stage("Loading Data") as counts:
+            ...
+            counts['points'] = 1000000
+        with profiler.stage("Interpolating Points", cells=250000):
+            ...
+        profiler.count('points', 1000000)
+        profiler.write('report.json')
+
+    A disabled profiler does nothing so callers don't need to check.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.counts = {}
+        self.info = {}
+        self.started = time.time()
+
+        # tracemalloc slows allocation down so only switch it on when someone wants a report
+        self.tracing = enabled and tracemalloc is not None
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Time and measure a block of code
+        :param name: What to call the stage in the report
+        :param counts: What the stage works through (e.g. points=n) for its throughput
+        :return: dict of the counts. Add to it inside the block for counts you only know later
+        """
+        counts = dict(counts)
+        if not self.enabled:
+            yield counts
+            return
+
+        wallStart = time.time()
+        cpuStart = _cpuTime()
+        if self.tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            traceStart = tracemalloc.get_traced_memory()[0]
+
+        try:
+            yield counts
+        finally:
+            record = {
+                'name': name,
+                'counts': dict((key, int(value)) for key, value in counts.items()),
+                'wall': time.time() - wallStart,
+                'cpu': _cpuTime() - cpuStart,
+                'peakRSS': _peakRSS(resource.RUSAGE_SELF) if resource is not None else None,
+                'childPeakRSS': _peakRSS(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            }
+            if self.tracing:
+                traceEnd, tracePeak = tracemalloc.get_traced_memory()
+                record['tracedDelta'] = traceEnd - traceStart
+                record['tracedPeak'] = tracePeak - traceStart
+            self.stages.append(record)
+
+    def count(self, name, value):
+        """
+        Remember a count (like 'points' or 'cells') for the throughput figures
+        :param name:
+        :param value:
+        :return:
+        """
+        self.counts[name] = int(value)
+
+    def report(self):
+        """
+        :return: dict with every stage, the counts and throughput (count per second of wall time).
+                 A stage's throughput only covers the counts it was given
+        """
+        total = time.time() - self.started
+        stages = []
+        for record in self.stages:
+            record = dict(record)
+            record['throughput'] = dict((name + '/s', value / record['wall'] if record['wall'] > 0 else None)
+                                        for name, value in record['counts'].items())
+            stages.append(record)
+
+        return {
+            'info': self.info,
+            'counts': self.counts,
+            'wall': total,
+            'cpu': _cpuTime(),
+            'peakRSS': _peakRSS(resource.RUSAGE_SELF) if resource is not None else None,
+            'childPeakRSS': _peakRSS(resource.RUSAGE_CHILDREN) if resource is not None else None,
+            'throughput': dict((name + '/s', value / total if total > 0 else None) for name, value in self.counts.items()),
+            'stages': stages,
+        }
+
+    def write(self, filepath):
+        """
+        Write the report to a JSON file
+        :param filepath:
+        :return:
+        """
+        with open(filepath, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+def _cpuTime():
+    """
+    User + system CPU seconds for this process and any children that have finished
+    :return:
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _peakRSS(who):
+    """
+    Peak resident set size in bytes
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    :return:
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
@@ -0,0 +1,147 @@
+import os
+import json
+import numpy as np
+from loghelper import Logger
+
+# Sidecars live next to the raster and look like: myraster.tif.p2r.json
+PROVENANCE_SUFFIX = '.p2r.json'
+
+# Bump this if what we store changes so old sidecars get turned away
+PROVENANCE_VERSION = 1
+
+# Points looked at in one go when working out which tiles they touch
+PROVENANCE_CHUNK = 4 * 1024 * 1024
+
+
+def ProvenancePath(sRaster):
+    """
+    :param sRaster: Path to the output raster
+    :return: Path to its provenance sidecar
+    """
+    return sRaster + PROVENANCE_SUFFIX
+
+
+def TouchedTiles(data, grid, tileSize, halo):
+    """
+    Work out which tiles a set of points can change: every tile whose window, grown by the halo,
+    has at least one of the points in it. That's the same window PointIndex.query hands the
+    engine so these are exactly the tiles that need gridding again if the points change.
+    :param data: N x (2 + k) array (or CompactPoints) of X, Y and value columns
+    :param grid: The output Grid
+    :param tileSize: Tile width and height in cells
+    :param halo: Halo in cells
+    :return: sorted array of flat (tile row * tile columns + tile column) tile numbers
+    """
+    tileCols, tileRows = grid.tileCount(tileSize)
+    touched = np.zeros(tileRows * tileCols, dtype=bool)
+
+    # A point u cells in can be in the halo of tiles floor((u - halo) / tileSize) - 1 to
+    # floor((u + halo) / tileSize). That's never more than this many either way
+    span = int(np.ceil(2.0 * halo / tileSize)) + 2
+
+    for start in range(0, data.shape[0], PROVENANCE_CHUNK):
+        u = (data[start:start + PROVENANCE_CHUNK, 0] - grid.left) / grid.cellWidth
+        v = (data[start:start + PROVENANCE_CHUNK, 1] - grid.top) / grid.cellHeight
+        tx = [np.ceil((u - halo) / tileSize - 1).astype(np.int64), np.floor((u + halo) / tileSize).astype(np.int64)]
+        ty = [np.ceil((v - halo) / tileSize - 1).astype(np.int64), np.floor((v + halo) / tileSize).astype(np.int64)]
+        del u, v
+
+        for dy in range(span):
+            row = ty[0] + dy
+            rowOk = (row <= ty[1]) & (row >= 0) & (row < tileRows)
+            for dx in range(span):
+                col = tx[0] + dx
+                ok = rowOk & (col <= tx[1]) & (col >= 0) & (col < tileCols)
+                touched[row[ok] * tileCols + col[ok]] = True
+
+    return np.flatnonzero(touched)
+
+
+def SourceRecord(sInput, sRaster, npoints, tiles):
+    """
+    What we remember about one input: enough to find it again, notice if it's changed and know
+    which tiles it feeds
+    :param sInput: Path to the point cloud
+    :param sRaster: Path to the raster (source paths are stored relative to it)
+    :param npoints: Number of points it had
+    :param tiles: Tile numbers it touches (see TouchedTiles)
+    :return: dict
+    """
+    stat = os.stat(sInput)
+    return {
+        'path': os.path.relpath(os.path.abspath(sInput), os.path.dirname(os.path.abspath(sRaster))),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'points': int(npoints),
+        'tiles': [int(tile) for tile in tiles],
+    }
+
+
+def SourcePath(source, sRaster):
+    """
+    :param source: dict from SourceRecord
+    :param sRaster: Path to the raster the sidecar belongs to
+    :return: Where the source is now
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(sRaster)), source['path'])
+
+
+def SourceChanged(source, sRaster):
+    """
+    :param source: dict from SourceRecord
+    :param sRaster:
+    :return: True if the file isn't the size or age it was when we gridded it
+    """
+    stat = os.stat(SourcePath(source, sRaster))
+    return stat.st_size != source['size'] or stat.st_mtime != source['mtime']
+
+
+def WriteProvenance(sRaster, grid, tileSize, origin, settings, sources):
+    """
+    Write the sidecar that lets pointcloud2raster-update patch the raster later: the grid, the
+    tile size and origin the values were worked out with, the gridding settings and which tiles
+    each input touched
+    :param sRaster: Path to the output raster
+    :param grid: The output Grid
+    :param tileSize: Tile size in cells
+    :param origin: (x, y) origin offset the engines used
+    :param settings: dict of the gridding settings
+    :param sources: list of dicts from SourceRecord, in the order they were loaded
+    :return: Path to the sidecar
+    """
+    log = Logger("Provenance")
+    sPath = ProvenancePath(sRaster)
+    provenance = {
+        'version': PROVENANCE_VERSION,
+        'grid': {'left': grid.left, 'top': grid.top, 'cellWidth': grid.cellWidth, 'cellHeight': grid.cellHeight,
+                 'rows': grid.rows, 'cols': grid.cols},
+        'tileSize': int(tileSize),
+        'origin': [float(origin[0]), float(origin[1])],
+        'settings': settings,
+        'sources': sources,
+    }
+
+    # Write then rename so a crash never leaves half a sidecar behind
+    tmpPath = sPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(provenance, f, sort_keys=True)
+    if os.path.isfile(sPath):
+        os.remove(sPath)
+    os.rename(tmpPath, sPath)
+    log.info("Provenance written: {}".format(sPath))
+    return sPath
+
+
+def ReadProvenance(sRaster):
+    """
+    :param sRaster: Path to the output raster
+    :return: dict written by WriteProvenance
+    """
+    sPath = ProvenancePath(sRaster)
+    if not os.path.isfile(sPath):
+        raise ValueError("{} has no provenance sidecar ({}). Grid it with --provenance first".format(sRaster, sPath))
+    with open(sPath, 'r') as f:
+        provenance = json.load(f)
+    if provenance.get('version') != PROVENANCE_VERSION:
+        raise ValueError("{} was written by a different version of pointcloud2raster. Grid it again".format(sPath))
+    return provenance
@@ -6,12 +6,27 @@ from scipy import interpolate
 # this allows GDAL to throw Python Exceptions
 gdal.UseExceptions()
 
-class Raster:
+# write() hands GDAL the array in row blocks of about this many cells so we never need a
+# filled copy of the whole thing
+WRITE_BLOCK_CELLS = 16 * 1024 * 1024
+
+COMPRESSION = ['LZW', 'DEFLATE', 'ZSTD', 'PACKBITS', 'NONE']
+BIGTIFF = ['IF_SAFER', 'IF_NEEDED', 'YES', 'NO']
+
+class Raster(object):
 
     def __init__(self, *args, **kwargs):
         self.log = Logger("Raster")
         self.filename = kwargs.get('filepath', None)
 
+        # The pixels and their stats get loaded lazily. See the array, min and max properties
+        self._array = None
+        self._min = None
+        self._max = None
+
+        # GeoTIFF creation options used by write() and create()
+        self.options = kwargs.get('options', CreationOptions())
+
         # Got a file. Load it
         if self.filename is not None:
             self.errs = ""
@@ -21,27 +36,14 @@ class Raster:
                 self.log.error('Unable to open %s' % self.filename, e)
                 raise e
             try:
-                # Read Raster Properties
+                # Read Raster Properties. Only the metadata: the pixels don't get read until
+                # someone asks for them (see the array property and readWindow)
                 srcband = src_ds.GetRasterBand(1)
                 self.bands = src_ds.RasterCount
                 self.driver = src_ds.GetDriver().LongName
                 self.gt = src_ds.GetGeoTransform()
                 self.nodata = srcband.GetNoDataValue()
-                """ Turn a Raster with a single band into a 2D [x,y] = v array """
-                self.array = srcband.ReadAsArray()
-
-                # Now mask out any NAN or nodata values (we do both for consistency)
-                if self.nodata is not None:
-                    self.array = np.ma.array(self.array, mask=(np.isnan(self.array) | (self.array == self.nodata)))
-
                 self.dataType = srcband.DataType
-                self.min = np.nanmin(self.array)
-                self.max = np.nanmax(self.array)
-
-                if self.min is np.ma.masked:
-                    self.min = np.nan
-                if self.max is np.ma.masked:
-                    self.max = np.nan
 
                 self.proj = src_ds.GetProjection()
 
@@ -61,9 +63,10 @@ class Raster:
                 # Important to throw away the srcband
                 srcband.FlushCache()
                 srcband = None
+                src_ds = None
 
             except RuntimeError as e:
-                self.log.error('Could not retrieve meta Data for %s' % self.filepath, e)
+                self.log.error('Could not retrieve meta Data for %s' % self.filename, e)
                 raise e
 
         # No file to load. this is a new raster
@@ -75,6 +78,7 @@ class Raster:
 
             self.rows = int(kwargs.get('rows', 0))
             self.cols = int(kwargs.get('cols', 0))
+            self.bands = int(kwargs.get('bands', 1))
             self.cellWidth = float(kwargs.get('cellWidth', 0.1))
             self.cellHeight = float(kwargs.get('cellHeight', -self.cellWidth))
             self.proj = kwargs.get('proj', "")
@@ -83,8 +87,6 @@ class Raster:
             tempArray = kwargs.get('array', None)
             if tempArray is not None:
                 self.setArray(tempArray)
-                self.min = np.nanmin(self.array)
-                self.max = np.nanmax(self.array)
 
             extent = kwargs.get('extent', None)
 
@@ -99,6 +101,87 @@ class Raster:
                 self.top = float(kwargs.get('top', -9999.0))
                 self.left = float(kwargs.get('left', -9999.0))
 
+    @property
+    def array(self):
+        """
+        The raster's values as a 2D [y,x] array (3D [y,x,band] if we're writing more than one
+        band). For a raster loaded from a file this reads the whole of band 1 the first time it's
+        asked for. Use readWindow() if you only need part of it.
+        """
+        if self._array is None and self.filename is not None:
+            self._array = self.readWindow(0, 0, self.cols, self.rows)
+        return self._array
+
+    @array.setter
+    def array(self, value):
+        self._array = value
+        self._min = None
+        self._max = None
+
+    @property
+    def min(self):
+        if self._min is None:
+            self._min, self._max = self._stats()
+        return self._min
+
+    @min.setter
+    def min(self, value):
+        self._min = value
+
+    @property
+    def max(self):
+        if self._max is None:
+            self._min, self._max = self._stats()
+        return self._max
+
+    @max.setter
+    def max(self, value):
+        self._max = value
+
+    def _stats(self):
+        """
+        Work out the min and max. If we haven't read the pixels, let GDAL scan the file a
+        block at a time rather than loading it all into memory.
+        :return: (min, max)
+        """
+        if self._array is None:
+            if self.filename is None:
+                return None, None
+            src_ds = gdal.Open(self.filename)
+            try:
+                return tuple(src_ds.GetRasterBand(1).ComputeRasterMinMax(False))
+            except RuntimeError:
+                # Every cell is nodata
+                return np.nan, np.nan
+            finally:
+                src_ds = None
+
+        rmin = np.nanmin(self._array)
+        rmax = np.nanmax(self._array)
+        if rmin is np.ma.masked:
+            rmin = np.nan
+        if rmax is np.ma.masked:
+            rmax = np.nan
+        return rmin, rmax
+
+    def readWindow(self, xoff, yoff, width, height):
+        """
+        Read a block of cells from the file this raster was loaded from
+        :param xoff: column offset of the block
+        :param yoff: row offset of the block
+        :param width: number of columns
+        :param height: number of rows
+        :return: 2D [y,x] array. Masked where the file has nan or nodata (if it has a nodata value)
+        """
+        src_ds = gdal.Open(self.filename)
+        arr = src_ds.GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+        src_ds = None
+
+        # Now mask out any NAN or nodata values (we do both for consistency)
+        if self.nodata is not None:
+            arr = np.ma.array(arr, mask=(np.isnan(arr) | (arr == self.nodata)))
+        return arr
+
     def setArray(self, incomingArray, copy=False):
         """
         You can use the self.array directly but if you want to copy from one array
@@ -106,7 +189,7 @@ class Raster:
         :param incomingArray:
         :return:
         """
-        masked = isinstance(self.array, np.ma.MaskedArray)
+        masked = isinstance(self._array, np.ma.MaskedArray)
         if copy:
             if masked:
                 self.array = np.ma.copy(incomingArray)
@@ -120,8 +203,7 @@ class Raster:
 
         self.rows = self.array.shape[0]
         self.cols = self.array.shape[1]
-        self.min = np.nanmin(self.array)
-        self.max = np.nanmax(self.array)
+        self.bands = self.array.shape[2] if self.array.ndim == 3 else 1
 
     def write(self, outputRaster):
         """
@@ -130,11 +212,25 @@ class Raster:
         :param outputRaster:
         :return:
         """
+        self.create(outputRaster)
+        blockRows = max(1, WRITE_BLOCK_CELLS // max(1, self.cols))
+        for yoff in range(0, self.rows, blockRows):
+            self.writeBlock(0, yoff, self.array[yoff:yoff + blockRows])
+        self.close()
+        self.log.debug("Finished Writing Raster: {0}".format(outputRaster))
+
+    def create(self, outputRaster):
+        """
+        Create an empty file on disk with this raster's dimensions and metadata so that it can
+        be filled in a block at a time with writeBlock(). Call close() when you're done.
+        :param outputRaster:
+        :return:
+        """
         if path.isfile(outputRaster):
             deleteRaster(outputRaster)
 
         driver = gdal.GetDriverByName('GTiff')
-        outRaster = driver.Create(outputRaster, self.cols, self.rows, 1, self.dataType, ['COMPRESS=LZW'])
+        self.outRaster = driver.Create(outputRaster, self.cols, self.rows, self.bands, self.dataType, self.options)
 
         # Remember:
         # [0]/* top left x */
@@ -143,30 +239,56 @@ class Raster:
         # [3]/* top left y */
         # [4]/* rotation, 0 if image is "north up" */
         # [5]/* n-s pixel resolution */
-        outRaster.SetGeoTransform([self.left, self.cellWidth, 0, self.top, 0, self.cellHeight])
-        outband = outRaster.GetRasterBand(1)
+        self.outRaster.SetGeoTransform([self.left, self.cellWidth, 0, self.top, 0, self.cellHeight])
+
+        spatialRef = osr.SpatialReference()
+        spatialRef.ImportFromWkt(self.proj)
+        self.outRaster.SetProjection(spatialRef.ExportToWkt())
 
         # Set nans to the original No Data Value
-        outband.SetNoDataValue(self.nodata)
+        for band in range(1, self.bands + 1):
+            self.outRaster.GetRasterBand(band).SetNoDataValue(self.nodata)
 
-        # TODO: Why isn't this working here???
-        # self.array.data[np.isnan(self.array)] = self.nodata
+    def update(self):
+        """
+        Open the file this raster was loaded from so writeBlock() can patch blocks of it in place.
+        Call close() when you're done.
+        :return:
+        """
+        self.outRaster = gdal.Open(self.filename, gdal.GA_Update)
+
+    def writeBlock(self, xoff, yoff, arr):
+        """
+        Write a block of values into a raster opened with create() or update()
+        :param xoff: column offset of the block
+        :param yoff: row offset of the block
+        :param arr: 2D [y,x] array, or 3D [y,x,band] for a multi-band raster. Masked or nan cells
+                    get written as nodata
+        :return:
+        """
         # Any mask that gets passed in here should have masked out elements set to
         # Nodata Value
-        if isinstance(self.array, np.ma.MaskedArray):
-            np.ma.set_fill_value(self.array, self.nodata)
-            outband.WriteArray(self.array.filled())
+        if isinstance(arr, np.ma.MaskedArray):
+            arr = arr.filled(self.nodata)
         else:
-            outband.WriteArray(self.array)
+            arr = np.where(np.isnan(arr), self.nodata, arr)
 
-        spatialRef = osr.SpatialReference()
-        spatialRef.ImportFromWkt(self.proj)
+        if arr.ndim == 2:
+            arr = arr[:, :, np.newaxis]
+        for band in range(arr.shape[2]):
+            outband = self.outRaster.GetRasterBand(band + 1)
+            outband.WriteArray(arr[:, :, band], xoff, yoff)
+            outband = None
 
-        outRaster.SetProjection(spatialRef.ExportToWkt())
-        outband.FlushCache()
-        # Important to throw away the srcband
-        outband = None
-        self.log.debug("Finished Writing Raster: {0}".format(outputRaster))
+    def close(self):
+        """
+        Flush and close a raster opened with create() or update()
+        :return:
+        """
+        for band in range(1, self.bands + 1):
+            self.outRaster.GetRasterBand(band).FlushCache()
+        # Important to throw away the dataset so GDAL finishes writing the file
+        self.outRaster = None
 
     def PrintRawArray(self):
         """
@@ -235,6 +357,26 @@ class Raster:
             print "{0}:: {1}".format(row, rowStr)
         print "\n"
 
+def CreationOptions(compress='LZW', tiled=False, blockSize=256, bigtiff='IF_SAFER', predictor=None):
+    """
+    Build a list of GeoTIFF creation options
+    :param compress: One of COMPRESSION
+    :param tiled: Write internal tiles instead of strips
+    :param blockSize: Internal tile width and height (only used when tiled)
+    :param bigtiff: One of BIGTIFF. IF_SAFER lets GDAL switch to BigTIFF for files that might go over 4GB
+    :param predictor: 1 (none), 2 (horizontal differencing) or 3 (floating point). Only used with compression
+    :return: list of 'KEY=VALUE' strings for gdal's Create()
+    """
+    options = ['BIGTIFF={}'.format(bigtiff)]
+    if compress is not None and compress != 'NONE':
+        options.append('COMPRESS={}'.format(compress))
+        if predictor is not None:
+            options.append('PREDICTOR={}'.format(predictor))
+    if tiled:
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(blockSize), 'BLOCKYSIZE={}'.format(blockSize)]
+    return options
+
+
 def deleteRaster(sFullPath):
     """
 
@@ -0,0 +1,96 @@
+import numpy as np
+
+# Barycentric slack for deciding a cell center is inside a triangle. Same as scipy's find_simplex
+# so centers that land on an edge (or just outside the hull) agree with LinearNDInterpolator.
+EPS = 100 * np.finfo(np.float64).eps
+
+# Candidate cells we're willing to test in one go. Keeps the temporaries bounded.
+CHUNK_CELLS = 4 * 1024 * 1024
+
+
+def TriangleCells(points, simplices, grid, origin=(0.0, 0.0)):
+    """
+    Find the grid cell centers covered by each triangle.
+
+    Rather than locating every cell in the triangulation (a point-location walk per cell) we go
+    the other way: every triangle's bounding box gives a handful of candidate cells and we keep
+    the ones whose centers have non-negative barycentric coordinates. That's O(cells + triangles).
+
+    :param points: N x 2 array of triangle vertices
+    :param simplices: M x 3 array of vertex indices
+    :param grid: The Grid whose cell centers we're testing
+    :param origin: The offset that was taken off the points
+    :return: generator of (triangle index, flat cell index, M' x 3 barycentric weights) chunks
+    """
+    x0 = grid.left - origin[0]
+    y0 = grid.top - origin[1]
+    cw = grid.cellWidth
+    ch = grid.cellHeight
+
+    tx = points[simplices, 0]
+    ty = points[simplices, 1]
+
+    # The range of cell rows and columns whose centers fall inside each triangle's bounding box
+    ca = (tx.min(axis=1) - x0) / cw - 0.5
+    cb = (tx.max(axis=1) - x0) / cw - 0.5
+    ra = (ty.min(axis=1) - y0) / ch - 0.5
+    rb = (ty.max(axis=1) - y0) / ch - 0.5
+    c1 = np.maximum(np.ceil(np.minimum(ca, cb) - 1e-9), 0).astype(np.int64)
+    c2 = np.minimum(np.floor(np.maximum(ca, cb) + 1e-9), grid.cols - 1).astype(np.int64)
+    r1 = np.maximum(np.ceil(np.minimum(ra, rb) - 1e-9), 0).astype(np.int64)
+    r2 = np.minimum(np.floor(np.maximum(ra, rb) + 1e-9), grid.rows - 1).astype(np.int64)
+
+    ncols = np.maximum(c2 - c1 + 1, 0)
+    counts = ncols * np.maximum(r2 - r1 + 1, 0)
+
+    # Most triangles in a dense cloud don't contain a single cell center. Drop them now.
+    tris = np.flatnonzero(counts > 0)
+    if len(tris) == 0:
+        return
+
+    # Chunk the triangles so each chunk expands to a bounded number of candidates
+    cumulative = np.cumsum(counts[tris])
+    bounds = np.searchsorted(cumulative, np.arange(CHUNK_CELLS, cumulative[-1], CHUNK_CELLS))
+    for chunk in np.split(tris, np.unique(bounds + 1)):
+        if len(chunk) == 0:
+            continue
+
+        # One entry per (triangle, candidate cell)
+        n = counts[chunk]
+        tri = np.repeat(chunk, n)
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        col = c1[tri] + within % ncols[tri]
+        row = r1[tri] + within // ncols[tri]
+
+        px = x0 + (col + 0.5) * cw
+        py = y0 + (row + 0.5) * ch
+
+        ax, bx, cx = tx[tri, 0], tx[tri, 1], tx[tri, 2]
+        ay, by, cy = ty[tri, 0], ty[tri, 1], ty[tri, 2]
+        den = (by - cy) * (ax - cx) + (cx - bx) * (ay - cy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            l1 = ((by - cy) * (px - cx) + (cx - bx) * (py - cy)) / den
+            l2 = ((cy - ay) * (px - cx) + (ax - cx) * (py - cy)) / den
+            l3 = 1.0 - l1 - l2
+            inside = (l1 >= -EPS) & (l2 >= -EPS) & (l3 >= -EPS) & (den != 0)
+        yield tri[inside], (row * grid.cols + col)[inside], np.column_stack((l1[inside], l2[inside], l3[inside]))
+
+
+def RasterizeLinear(points, simplices, values, grid, origin=(0.0, 0.0), dtype=np.float64):
+    """
+    Linear interpolation of a triangulated surface onto the cell centers of a grid by rasterizing
+    the triangles directly.
+    :param points: N x 2 array of triangle vertices
+    :param simplices: M x 3 array of vertex indices
+    :param values: N array of values at the vertices, or N x k to do k columns with one pass
+                   over the triangles
+    :param grid: The Grid to interpolate onto
+    :param origin: The offset that was taken off the points
+    :param dtype: Type of the result
+    :return: rows x cols (x k) array with nan outside the triangulation
+    """
+    values = np.asarray(values)
+    result = np.full((grid.rows * grid.cols,) + values.shape[1:], np.nan, dtype=dtype)
+    for tri, cells, weights in TriangleCells(points, simplices, grid, origin):
+        result[cells] = np.einsum('ij,ij...->i...', weights, values[simplices[tri]])
+    return result.reshape((grid.rows, grid.cols) + values.shape[1:])
@@ -0,0 +1,162 @@
+import zipfile
+import numpy as np
+
+# Parquet support is optional
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# File signatures
+NPY_MAGIC = b'\x93NUMPY'
+NPZ_MAGIC = b'PK\x03\x04'
+PARQUET_MAGIC = b'PAR1'
+
+
+def TableFormat(sInput):
+    """
+    :param sInput: Path to a point cloud
+    :return: 'npy', 'npz' or 'parquet' from the file signature or None if it's none of them
+    """
+    with open(sInput, 'rb') as f:
+        head = f.read(len(NPY_MAGIC))
+    if head.startswith(NPY_MAGIC):
+        return 'npy'
+    if head.startswith(NPZ_MAGIC):
+        _checkArchive(sInput)
+        return 'npz'
+    if head.startswith(PARQUET_MAGIC):
+        return 'parquet'
+    return None
+
+
+def LoadNPYPoints(sInputNPY, usecols):
+    """
+    Load the selected columns of a point table saved with np.save. Either a 2D N x C numeric
+    array or a 1D structured array (its fields are the columns, in order).
+
+    The file is memory-mapped. If the columns we want are already float64 and sit next to each
+    other in the right order we hand back a view of the map without copying anything.
+
+    :param sInputNPY: Path to the .npy file
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :return: N x len(usecols) float64 array (possibly a read-only memmap)
+    """
+    table = np.load(sInputNPY, mmap_mode='r')
+    return _selectColumns(table, usecols, sInputNPY)
+
+
+def LoadNPZPoints(sInputNPZ, usecols):
+    """
+    Load the selected columns of a point table saved with np.savez. Either a single 2D (or
+    structured) array, or one 1D array per column (in the order they were saved). With one
+    array per column only the ones we ask for get read.
+
+    .npz files are zip archives so they can't be memory-mapped.
+
+    :param sInputNPZ: Path to the .npz file
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :return: N x len(usecols) float64 array
+    """
+    with np.load(sInputNPZ) as archive:
+        names = _archiveOrder(sInputNPZ, archive.files)
+        if len(names) == 1:
+            return _selectColumns(archive[names[0]], usecols, sInputNPZ)
+
+        _checkColumns(usecols, len(names), sInputNPZ)
+        columns = [archive[names[col]] for col in usecols]
+
+    if any(column.ndim != 1 or len(column) != len(columns[0]) for column in columns):
+        raise ValueError("Every array in {} needs to be one column of the same length".format(sInputNPZ))
+    return np.column_stack(columns).astype(np.float64, copy=False)
+
+
+def LoadParquetPoints(sInputParquet, usecols):
+    """
+    Load the selected columns of a Parquet table. Only the columns we ask for are read
+    from disk. Needs pyarrow.
+    :param sInputParquet: Path to the Parquet file
+    :param usecols: Zero-indexed column numbers to keep (in output order)
+    :return: N x len(usecols) float64 array
+    """
+    if pq is None:
+        raise ValueError("{} is a Parquet file. Reading Parquet needs pyarrow (pip install pyarrow)".format(sInputParquet))
+
+    names = pq.ParquetFile(sInputParquet).schema.names
+    _checkColumns(usecols, len(names), sInputParquet)
+    table = pq.read_table(sInputParquet, columns=[names[col] for col in usecols])
+
+    result = np.empty((table.num_rows, len(usecols)))
+    for idx, col in enumerate(usecols):
+        column = table.column(names[col])
+        result[:, idx] = column.to_numpy() if hasattr(column, 'to_numpy') else column.to_pandas().values
+    return result
+
+
+def _selectColumns(table, usecols, source):
+    """
+    Pull columns out of a 2D or structured array without copying if we can help it
+    :param table:
+    :param usecols:
+    :param source: File name for error messages
+    :return: N x len(usecols) float64 array
+    """
+    usecols = list(usecols)
+
+    if table.dtype.names is not None:
+        # Structured: every field is a column
+        names = table.dtype.names
+        _checkColumns(usecols, len(names), source)
+        result = np.empty((len(table), len(usecols)))
+        for idx, col in enumerate(usecols):
+            result[:, idx] = table[names[col]]
+        return result
+
+    if table.ndim != 2:
+        raise ValueError("Expected a 2D array of points in {} but got shape {}".format(source, table.shape))
+    _checkColumns(usecols, table.shape[1], source)
+
+    # Consecutive columns are a plain slice: a view, not a copy
+    if table.dtype == np.float64 and usecols == list(range(usecols[0], usecols[0] + len(usecols))):
+        return table[:, usecols[0]:usecols[0] + len(usecols)]
+    return table[:, usecols].astype(np.float64)
+
+
+def _checkArchive(sInputNPZ):
+    """
+    An .npz is a zip but plenty of zips aren't an .npz. np.savez only ever writes .npy members so
+    anything else (a zipped CSV, a shapefile bundle...) gets turned away here with a clear error
+    instead of failing somewhere inside np.load.
+    :param sInputNPZ:
+    :return:
+    """
+    try:
+        with zipfile.ZipFile(sInputNPZ) as archive:
+            names = archive.namelist()
+    except zipfile.BadZipfile:
+        raise ValueError("{} looks like a zip archive but can't be opened as one".format(sInputNPZ))
+    if len(names) == 0 or not all(name.endswith('.npy') for name in names):
+        raise ValueError("{} is a zip archive but not a numpy .npz (it should only hold .npy arrays). Unzip it "
+                         "first".format(sInputNPZ))
+
+
+def _checkColumns(usecols, ncols, source):
+    if max(usecols) >= ncols or min(usecols) < 0:
+        raise ValueError("Column {} requested but {} only has {} columns".format(max(usecols) + 1, source, ncols))
+
+
+def _archiveOrder(sInputNPZ, files):
+    """
+    np.savez names positional arrays arr_0, arr_1... Sort those numerically. Keyword arguments
+    don't keep their order on every Python so arrays called x, y and z (any case) come first in
+    that order and anything else follows in the order it sits in the archive.
+    :param sInputNPZ:
+    :param files:
+    :return: list of array names
+    """
+    if all(name.startswith('arr_') and name[4:].isdigit() for name in files):
+        return sorted(files, key=lambda name: int(name[4:]))
+
+    lower = [name.lower() for name in files]
+    axes = [files[lower.index(axis)] for axis in ['x', 'y', 'z'] if axis in lower]
+    return axes + [name for name in files if name not in axes]
@@ -0,0 +1,70 @@
+import numpy as np
+
+# Every --thin strategy we know about
+THINNING = ['none', 'keep', 'centroid', 'minmax']
+
+
+def ThinPoints(data, grid, method='centroid', keep=1):
+    """
+    Cut a dense cloud down before it gets triangulated. With several points in every output
+    cell most of them don't change the answer at that cell size but they all cost QHull time
+    and memory.
+
+    Points get grouped by the output cell they land in (a flat cell index, so no spatial
+    search) and each group is reduced with one of:
+        keep:     The first `keep` points in the cell, in file order
+        centroid: One point per cell at the mean X, Y and value(s) of its points
+        minmax:   The points with the lowest and highest value in the cell (so peaks and pits survive)
+
+    Points outside the grid are kept as they are.
+
+    :param data: N x (2 + k) array of X, Y and value columns. minmax uses the first value column
+    :param grid: The output Grid
+    :param method: One of THINNING
+    :param keep: Points per cell for the keep method
+    :return: M x (2 + k) array with M <= N
+    """
+    if method not in THINNING:
+        raise ValueError("Unknown thinning '{}'. Must be one of {}".format(method, ', '.join(THINNING)))
+    if method == 'keep' and keep < 1:
+        raise ValueError("Thinning has to keep at least 1 point per cell, not {}".format(keep))
+    if method == 'none' or data.shape[0] == 0:
+        return data
+
+    cells = grid.cellIndex(data[:, 0], data[:, 1])
+    outside = np.flatnonzero(cells < 0)
+
+    if method == 'centroid':
+        # Straight sums per cell, no sorting needed
+        inside = cells >= 0
+        cells = cells[inside]
+        ncells = grid.rows * grid.cols
+        counts = np.bincount(cells, minlength=ncells)
+        occupied = np.flatnonzero(counts)
+        result = np.empty((len(occupied) + len(outside), data.shape[1]), dtype=data.dtype)
+        for col in range(data.shape[1]):
+            sums = np.bincount(cells, weights=data[:, col][inside], minlength=ncells)
+            result[:len(occupied), col] = sums[occupied] / counts[occupied]
+        result[len(occupied):] = data[outside, :]
+        return result
+
+    # Sort-based grouping (like binning.py): every cell's points end up together
+    if method == 'minmax':
+        order = np.lexsort((data[:, 2], cells))
+    else:
+        order = np.argsort(cells, kind='mergesort')
+    sortedCells = cells[order]
+    starts = np.flatnonzero(np.concatenate(([True], sortedCells[1:] != sortedCells[:-1])))
+    starts = starts[sortedCells[starts] >= 0]
+
+    if method == 'keep':
+        ends = np.concatenate((starts[1:], [len(order)]))
+        n = np.minimum(ends - starts, keep)
+        within = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        chosen = order[np.repeat(starts, n) + within]
+    else:
+        ends = np.concatenate((starts[1:], [len(order)])) - 1
+        chosen = np.concatenate((order[starts], order[ends]))
+
+    # Put them back in file order (which also drops the duplicate when min and max are the same point)
+    return data[np.union1d(chosen, outside)]
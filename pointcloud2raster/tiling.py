@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from loghelper import Logger
+from interpolators import InterpolateGrid, PointValues
+from compact import CompactPoints
+from footprint import TileFootprint
+
+# How many cells of neighbouring data each tile gets to see by default. Triangles that cross a
+# tile edge need their far corners to come from inside this margin for seams to match a
+# single-pass run, so sparse clouds may need more.
+DEFAULT_HALO = 10
+
+# Tile size used when we're asked for more than one worker but not told how to split the grid
+DEFAULT_TILESIZE = 512
+
+# Rows copied at a time when writing the tile-sorted points out for the workers
+SORT_CHUNK = 4 * 1024 * 1024
+
+# Per-process state for pool workers. Set by _initTileWorker
+_worker = {}
+
+
+class PointIndex(object):
+    """
+    Buckets points by the output tile they land in so that a tile (plus its halo) can find
+    its points without scanning the whole cloud.
+    """
+
+    def __init__(self, data, grid, tileSize, starts=None):
+        """
+        :param data: N x (2 + k) array (or CompactPoints) of X, Y and value columns
+        :param grid: The output Grid
+        :param tileSize: Tile width and height in cells
+        :param starts: Bucket offsets from another index. If given the points must already be
+                       sorted by bucket (see sortedCopy) and we skip the sort.
+        """
+        self.data = data
+        self.grid = grid
+        self.tileSize = tileSize
+        self.tileCols, self.tileRows = grid.tileCount(tileSize)
+
+        if starts is not None:
+            self.order = None
+            self.starts = starts
+            return
+
+        tx = np.floor((data[:, 0] - grid.left) / (tileSize * grid.cellWidth)).astype(np.int64)
+        ty = np.floor((data[:, 1] - grid.top) / (tileSize * grid.cellHeight)).astype(np.int64)
+        np.clip(tx, 0, self.tileCols - 1, out=tx)
+        np.clip(ty, 0, self.tileRows - 1, out=ty)
+        bucket = ty * self.tileCols + tx
+        del tx, ty
+
+        # Stable sort so points keep their file order within a bucket
+        self.order = np.argsort(bucket, kind='mergesort')
+        counts = np.bincount(bucket, minlength=self.tileCols * self.tileRows)
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+
+    def query(self, xoff, yoff, cols, rows, halo):
+        """
+        Find the points that fall inside a window of the grid grown by a halo
+        :param xoff: column offset of the window
+        :param yoff: row offset of the window
+        :param cols:
+        :param rows:
+        :param halo: Number of cells to grow the window by on every side
+        :return: array of indices into the original points
+        """
+        ts = self.tileSize
+        c1 = max(0, (xoff - halo) // ts)
+        c2 = min(self.tileCols - 1, (xoff + cols + halo - 1) // ts)
+        r1 = max(0, (yoff - halo) // ts)
+        r2 = min(self.tileRows - 1, (yoff + rows + halo - 1) // ts)
+
+        # Buckets in the same tile row are contiguous so we only need one slice per row
+        chunks = []
+        for row in range(r1, r2 + 1):
+            start = self.starts[row * self.tileCols + c1]
+            end = self.starts[row * self.tileCols + c2 + 1]
+            chunks.append(self.order[start:end] if self.order is not None else np.arange(start, end))
+        idx = np.concatenate(chunks) if len(chunks) > 0 else np.empty(0, dtype=np.int64)
+
+        xmin, xmax, ymin, ymax = self.grid.window(xoff, yoff, cols, rows).bounds(halo)
+        x = self.data[idx, 0]
+        y = self.data[idx, 1]
+        return idx[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+    def sortedCopy(self, data, filepath):
+        """
+        Write the points out to a .npy file in bucket order so other processes can memory-map
+        them and find a tile's points as contiguous slices (pass self.starts to their index).
+        :param data: N x (2 + k) array (or CompactPoints) this index was built from
+        :param filepath: Where to write the .npy
+        :return: read-only memmap of the sorted points
+        """
+        if isinstance(data, CompactPoints):
+            return data.sortedCopy(self.order, filepath)
+
+        out = np.lib.format.open_memmap(filepath, mode='w+', dtype=data.dtype, shape=data.shape)
+        for start in range(0, data.shape[0], SORT_CHUNK):
+            out[start:start + SORT_CHUNK] = data[self.order[start:start + SORT_CHUNK]]
+        out.flush()
+        del out
+        return np.load(filepath, mmap_mode='r')
+
+
+def GridTiles(data, grid, raster, tileSize, halo, origin_offset, method='linear', workers=1, options=None,
+              footprint=None, tiles=None):
+    """
+    Interpolate one tile at a time and write each one into the output raster as we go so
+    memory is bounded by the tile size rather than by the size of the whole raster.
+
+    Each tile is triangulated from only the points inside it plus a halo of neighbouring cells.
+    :param data: N x (2 + k) array (or CompactPoints) of X, Y and k value columns
+    :param grid: The output Grid
+    :param raster: Raster that has already been created on disk
+    :param tileSize: Tile width and height in cells
+    :param halo: Number of cells of neighbouring data each tile gets to see
+    :param origin_offset:
+    :param method: Interpolation engine. One of the keys in interpolators.ENGINES
+    :param workers: Number of processes to farm tiles out to
+    :param options: dict of engine-specific settings
+    :param footprint: dict from footprint.TiledFootprint or None. Each tile works out its own
+                      footprint and tiles entirely outside it don't get gridded at all
+    :param tiles: Only grid these tiles (flat tile row * tile columns + tile column numbers). None means all of them
+    :return:
+    """
+    log = Logger("GridTiles")
+    index = PointIndex(data, grid, tileSize)
+    allTiles = list(grid.tiles(tileSize))
+    tiles = allTiles if tiles is None else [allTiles[tile] for tile in tiles]
+
+    if workers <= 1 or len(tiles) < 2:
+        for tileNum, tile in enumerate(tiles):
+            xoff, yoff, tileArray = _gridTile(data, index, grid, tile, halo, origin_offset, method, options,
+                                              footprint)
+            log.debug("Tile {}/{} done at ({}, {})".format(tileNum + 1, len(tiles), xoff, yoff))
+            raster.writeBlock(xoff, yoff, tileArray)
+        return
+
+    # Workers memory-map a tile-sorted copy of the points rather than getting their own pickled
+    # copy of the whole cloud. The parent writes tiles out in whatever order they finish.
+    tempDir = tempfile.mkdtemp(prefix='pointcloud2raster_')
+    try:
+        sortedPath = os.path.join(tempDir, 'points.npy')
+        index.sortedCopy(data, sortedPath)
+        starts = index.starts
+        del index
+
+        log.info("Gridding {} tiles using {} workers...".format(len(tiles), workers))
+        pool = multiprocessing.Pool(workers, initializer=_initTileWorker,
+                                    initargs=(sortedPath, starts, grid, tileSize, halo, origin_offset, method, options,
+                                              footprint, isinstance(data, CompactPoints)))
+        try:
+            for tileNum, (xoff, yoff, tileArray) in enumerate(pool.imap_unordered(_gridTileWorker, tiles)):
+                log.debug("Tile {}/{} done at ({}, {})".format(tileNum + 1, len(tiles), xoff, yoff))
+                raster.writeBlock(xoff, yoff, tileArray)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+
+def _gridTile(data, index, grid, tile, halo, origin_offset, method, options, footprint=None):
+    """
+    Interpolate a single tile from the points inside it and its halo
+    :param data: N x (2 + k) array of X, Y and k value columns
+    :param index: PointIndex over data
+    :param grid: The output Grid
+    :param tile: (xoff, yoff, cols, rows)
+    :param halo:
+    :param origin_offset:
+    :param method:
+    :param options:
+    :param footprint: dict from footprint.TiledFootprint or None
+    :return: (xoff, yoff, rows x cols (x k) array)
+    """
+    xoff, yoff, cols, rows = tile
+    window = grid.window(xoff, yoff, cols, rows)
+    empty = (rows, cols) + PointValues(data[:0]).shape[1:]
+
+    # The hull doesn't need the tile's points so tiles outside it get skipped before we go looking
+    tileMask = None
+    if footprint is not None and footprint['method'] == 'hull':
+        tileMask = TileFootprint(None, window, origin_offset, footprint)
+        if not tileMask.any():
+            return xoff, yoff, np.full(empty, np.nan)
+
+    tilePoints = data[index.query(xoff, yoff, cols, rows, halo)]
+    if isinstance(tilePoints, CompactPoints):
+        # Straight from the stored offsets so there's only one float64 copy of the XY
+        xy, tileOrigin = tilePoints.offsetXY(), tilePoints.origin
+    else:
+        xy, tileOrigin = tilePoints[:, [0, 1]] - origin_offset, origin_offset
+
+    if footprint is not None and footprint['method'] == 'alpha':
+        tileMask = TileFootprint(xy, window, tileOrigin, footprint)
+        if tileMask is not None and not tileMask.any():
+            return xoff, yoff, np.full(empty, np.nan)
+
+    tileArray = InterpolateGrid(xy, PointValues(tilePoints), window, tileOrigin, method, options=options, mask=tileMask,
+                                offset=False)
+    return xoff, yoff, tileArray
+
+
+def _initTileWorker(sortedPath, starts, grid, tileSize, halo, origin_offset, method, options, footprint=None,
+                    compact=False):
+    """
+    Set up a pool worker: memory-map the sorted points and rebuild the index around them
+    :return:
+    """
+    data = CompactPoints.load(sortedPath) if compact else np.load(sortedPath, mmap_mode='r')
+    _worker['data'] = data
+    _worker['index'] = PointIndex(data, grid, tileSize, starts=starts)
+    _worker['grid'] = grid
+    _worker['halo'] = halo
+    _worker['origin_offset'] = origin_offset
+    _worker['method'] = method
+    _worker['options'] = options
+    _worker['footprint'] = footprint
+
+
+def _gridTileWorker(tile):
+    """
+    Pool entry point for one tile
+    :param tile: (xoff, yoff, cols, rows)
+    :return: (xoff, yoff, rows x cols array)
+    """
+    return _gridTile(_worker['data'], _worker['index'], _worker['grid'], tile, _worker['halo'], _worker['origin_offset'],
+                     _worker['method'], _worker['options'], _worker['footprint'])
@@ -0,0 +1,85 @@
+import os
+import hashlib
+import numpy as np
+from loghelper import Logger
+
+# Cache files look like: <folder>/<digest>.p2r.tri.npz
+TRICACHE_SUFFIX = '.p2r.tri.npz'
+
+# Bump this if what we store changes so old files just stop matching
+TRICACHE_VERSION = 2
+
+
+def LoadTriangulation(cacheDir, points):
+    """
+    Look for a saved Delaunay triangulation of exactly these points.
+
+    The key is a hash of the coordinates themselves (after the origin offset has been taken off)
+    so it doesn't matter which file they came from, what cell size we're gridding at or what
+    the Z values are. Same XY, same triangles.
+
+    :param cacheDir: Folder the triangulations are kept in
+    :param points: N x 2 array of (offset) X, Y
+    :return: M x 3 array of simplices or None if we don't have it
+    """
+    log = Logger("TriCache")
+    sCachePath = TriangulationPath(cacheDir, points)
+    if not os.path.isfile(sCachePath):
+        return None
+
+    try:
+        with np.load(sCachePath) as cached:
+            if int(cached['version']) != TRICACHE_VERSION or int(cached['npoints']) != points.shape[0]:
+                return None
+            simplices = cached['simplices'].astype(np.intp)
+    except (IOError, OSError, KeyError, ValueError) as e:
+        log.warning("Ignoring unreadable triangulation cache {}".format(sCachePath), e)
+        return None
+
+    log.info("Using triangulation cache: {}".format(sCachePath))
+    return simplices
+
+
+def SaveTriangulation(cacheDir, points, tri):
+    """
+    Save a triangulation so LoadTriangulation can find it next time. Only the simplices get kept:
+    nothing that reads the cache walks from triangle to triangle.
+    :param cacheDir: Folder the triangulations are kept in (created if it isn't there)
+    :param points: N x 2 array of (offset) X, Y that were triangulated
+    :param tri: scipy.spatial.Delaunay
+    :return: The path we wrote or None if we couldn't
+    """
+    log = Logger("TriCache")
+    sCachePath = TriangulationPath(cacheDir, points)
+
+    # Indices fit in 32 bits for anything we can realistically triangulate. Half the size on disk.
+    indexType = np.int32 if points.shape[0] < np.iinfo(np.int32).max else np.int64
+
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+        # Pool workers can be writing at the same time so every process gets its own temp file
+        tmpPath = '{}.{}.tmp'.format(sCachePath, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            np.savez(f, version=TRICACHE_VERSION, npoints=points.shape[0],
+                     simplices=tri.simplices.astype(indexType))
+        os.rename(tmpPath, sCachePath)
+        log.info("Triangulation cache written: {}".format(sCachePath))
+    except (IOError, OSError) as e:
+        # A read-only folder shouldn't stop us from gridding
+        log.warning("Could not write triangulation cache {}".format(sCachePath), e)
+        return None
+
+    return sCachePath
+
+
+def TriangulationPath(cacheDir, points):
+    """
+    Work out the cache file for a set of points
+    :param cacheDir:
+    :param points: N x 2 array of (offset) X, Y
+    :return:
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(points, dtype=np.float64)).hexdigest()
+    return os.path.join(cacheDir, digest + TRICACHE_SUFFIX)
@@ -32,8 +32,11 @@ setup(
       packages=['pointcloud2raster'],
       zip_safe=False,
       install_requires=install_requires,
+      extras_require={'parquet': ['pyarrow']},
       entry_points={
-            "console_scripts": ['pointcloud2raster = pointcloud2raster.pointcloud2raster:main']
+            "console_scripts": ['pointcloud2raster = pointcloud2raster.pointcloud2raster:main',
+                                'pointcloud2raster-batch = pointcloud2raster.batch:main',
+                                'pointcloud2raster-update = pointcloud2raster.incremental:main']
       },
       version=version,
       long_description=long_descr,
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+from pointcloud2raster.raster import Raster
+import datafactory
+import numpy as np
+import subprocess
+import argparse
+import datetime
+import json
+import math
+import sys
+import os
+
+"""
+
+    Performance benchmark. Builds synthetic surfaces with datafactory at a range of point counts,
+    runs each one through the tool with every method we ask for and records time, peak memory
+    and RMSE against the source raster.
+
+    With --precisions double compact every run happens at both precisions and the compact
+    results also record how far they are from the double ones.
+
+    Results go to a JSON file. Pass an older results file with --compare to flag slowdowns.
+
+"""
+
+# The surfaces we know how to make. Each one takes (width, height)
+SURFACES = {
+    'slopey': lambda w, h: datafactory.slopeyArray(w, h, 980, 950),
+    'tiltyslopey': lambda w, h: datafactory.tiltySlopeyArray(w, h, 980, 950, "N"),
+    'checkerboard': lambda w, h: datafactory.checkerBoardArray(w, h, 950, 980),
+    'sine': lambda w, h: datafactory.sineArray(w, h, 980, 950),
+    'sawtooth': lambda w, h: datafactory.sawtoothArray(w, h, 950, 980),
+}
+
+# datafactory drops between 3 and 15 points into every cell of the cloud
+POINTS_PER_CELL = 9.0
+
+# Methods that don't estimate the surface so there's no sense in an RMSE
+NO_RMSE = ['count', 'stdev']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+                        help='Approximate point counts to test (defaults to 1e4 1e5 1e6). Goes up to 1e8 and beyond',
+                        nargs='+',
+                        default=['1e4', '1e5', '1e6'],
+                        type=str)
+    parser.add_argument('--methods',
+                        help='Methods to run (defaults to linear nearest cubic idw mean median)',
+                        nargs='+',
+                        default=['linear', 'nearest', 'cubic', 'idw', 'mean', 'median'],
+                        type=str)
+    parser.add_argument('--surfaces',
+                        help='Surfaces to build. Any of: {}'.format(', '.join(sorted(SURFACES))),
+                        nargs='+',
+                        default=['sine'],
+                        choices=sorted(SURFACES),
+                        type=str)
+    parser.add_argument('--precisions',
+                        help='--precision settings to run each method at (defaults to double). Give "double compact" '
+                             'to see what compact does to memory and accuracy',
+                        nargs='+',
+                        default=['double'],
+                        choices=['double', 'compact'],
+                        type=str)
+    parser.add_argument('--args',
+                        help='Extra arguments to pass to pointcloud2raster (quote them: --args "--workers 4")',
+                        default='',
+                        type=str)
+    parser.add_argument('--folder',
+                        help='Where to put the generated data (defaults to data/benchmark)',
+                        default=os.path.join(os.path.dirname(__file__), "data", "benchmark"),
+                        type=str)
+    parser.add_argument('--output',
+                        help='Results JSON file (defaults to benchmark.json in the folder)',
+                        type=str)
+    parser.add_argument('--compare',
+                        help='Earlier results JSON file to compare against',
+                        type=str)
+    parser.add_argument('--tolerance',
+                        help='Fractional slowdown allowed before --compare complains (defaults to 0.1)',
+                        default=0.1,
+                        type=float)
+    args = parser.parse_args()
+
+    try:
+        os.makedirs(args.folder)
+    except:
+        print "folder exists"
+
+    templatefile = os.path.join(os.path.dirname(__file__), "data", "template.tif")
+    template = Raster(filepath=templatefile)
+    extra = args.args.split()
+
+    results = []
+    for surface in args.surfaces:
+        for size in args.sizes:
+            side = max(2, int(round(math.sqrt(float(size) / POINTS_PER_CELL))))
+            basename = os.path.join(args.folder, "{}_{}".format(surface, side))
+            if not os.path.isfile(basename + "_cloud.csv"):
+                print "Generating {} ({} x {} cells)...".format(surface, side, side)
+                datafactory.array2rastercsv(SURFACES[surface](side, side), basename, template)
+            points = countLines(basename + "_cloud.csv")
+
+            for method in args.methods:
+                outputs = {}
+                for precision in args.precisions:
+                    print "Running {} ({}) on {} with {} points...".format(method, precision, surface, points)
+                    result = runOne(basename, method, extra, precision)
+                    result.update({'surface': surface, 'side': side, 'points': points, 'method': method,
+                                   'precision': precision})
+                    outputs[precision] = result.pop('output')
+                    if precision != 'double' and 'double' in outputs:
+                        result['vsDouble'] = difference(outputs['double'], outputs[precision])
+                    results.append(result)
+                    print "    {:.2f}s wall  {:.2f}s cpu  {:.1f}MB peak  RMSE: {}".format(
+                        result['wall'], result['cpu'], result['peakRSS'] / 1048576.0, result['rmse'])
+                    if 'vsDouble' in result:
+                        print "    vs double: max |diff| {maxAbs}  RMSE {rmse}  cells that changed nodata {nodata}".format(
+                            **result['vsDouble'])
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': gitCommit(),
+        'python': sys.version.split()[0],
+        'args': extra,
+        'results': results,
+    }
+    outputfile = args.output or os.path.join(args.folder, "benchmark.json")
+    with open(outputfile, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to {}".format(outputfile)
+
+    if args.compare:
+        if compare(args.compare, report, args.tolerance) > 0:
+            sys.exit(1)
+
+
+def runOne(basename, method, extra, precision='double'):
+    """
+    Run the tool on one cloud in its own process (so peak memory isn't polluted by earlier runs)
+    :param basename: The cloud, source raster etc. share this name
+    :param method:
+    :param extra: Extra command line arguments
+    :param precision: --precision to run at
+    :return: dict of timings, memory and accuracy (and the output file)
+    """
+    outputfile = "{}_{}_{}_output.tif".format(basename, method, precision)
+    profilefile = "{}_{}_{}_profile.json".format(basename, method, precision)
+
+    cmd = [sys.executable, '-c', 'from pointcloud2raster.pointcloud2raster import main; main()',
+           basename + "_cloud.csv", outputfile,
+           '--templateraster', basename + ".tif",
+           '--method', method,
+           '--precision', precision,
+           '--profile', profilefile] + extra
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+
+    with open(profilefile) as f:
+        profile = json.load(f)
+
+    return {
+        'wall': profile['wall'],
+        'cpu': profile['cpu'],
+        'peakRSS': max(profile['peakRSS'] or 0, profile['childPeakRSS'] or 0),
+        'cells': profile['counts']['cells'],
+        'stages': dict((stage['name'], stage['wall']) for stage in profile['stages']),
+        'rmse': rmse(basename + ".tif", outputfile) if method not in NO_RMSE else None,
+        'output': outputfile,
+    }
+
+
+def difference(firstfile, secondfile):
+    """
+    How far apart two outputs of the same cloud are
+    :param firstfile:
+    :param secondfile:
+    :return: dict of the biggest difference, the RMSE and how many cells are nodata in one but not the other
+    """
+    first = Raster(filepath=firstfile).array
+    second = Raster(filepath=secondfile).array
+    if first.shape != second.shape:
+        return {'maxAbs': None, 'rmse': None, 'nodata': None}
+
+    diff = (first - second).compressed().astype(np.float64)
+    return {
+        'maxAbs': float(np.abs(diff).max()) if diff.size > 0 else None,
+        'rmse': float(np.sqrt(np.mean(diff ** 2))) if diff.size > 0 else None,
+        'nodata': int((np.ma.getmaskarray(first) != np.ma.getmaskarray(second)).sum()),
+    }
+
+
+def rmse(sourcefile, outputfile):
+    """
+    Root mean square error between the source surface and our output over the cells they share
+    :param sourcefile:
+    :param outputfile:
+    :return:
+    """
+    source = Raster(filepath=sourcefile)
+    output = Raster(filepath=outputfile)
+
+    # The output is cropped to the data so it might not line up with the source exactly
+    xoff = int(round((output.left - source.left) / source.cellWidth))
+    yoff = int(round((output.top - source.top) / source.cellHeight))
+    cols = min(source.cols - max(xoff, 0), output.cols - max(-xoff, 0))
+    rows = min(source.rows - max(yoff, 0), output.rows - max(-yoff, 0))
+    if cols <= 0 or rows <= 0:
+        return None
+
+    src = source.readWindow(max(xoff, 0), max(yoff, 0), cols, rows).astype(np.float64)
+    out = output.readWindow(max(-xoff, 0), max(-yoff, 0), cols, rows).astype(np.float64)
+    diff = np.ma.masked_invalid(src - out)
+    if diff.count() == 0:
+        return None
+    return float(np.sqrt(np.mean(diff.compressed() ** 2)))
+
+
+def compare(baselinefile, report, tolerance):
+    """
+    Print how each result did against an earlier run
+    :param baselinefile: Earlier results JSON
+    :param report: This run's results
+    :param tolerance: Fractional slowdown we'll put up with
+    :return: The number of results that got slower than the tolerance allows
+    """
+    with open(baselinefile) as f:
+        baseline = json.load(f)
+    before = dict(((r['surface'], r['side'], r['method'], r.get('precision', 'double')), r) for r in baseline['results'])
+
+    print "\n----------- Compared to {} -----------".format(baseline.get('commit'))
+    regressions = 0
+    for result in report['results']:
+        old = before.get((result['surface'], result['side'], result['method'], result['precision']))
+        if old is None:
+            continue
+        ratio = result['wall'] / old['wall'] if old['wall'] > 0 else float('inf')
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  <-- SLOWER"
+            regressions += 1
+        print "{} {} {} ({}): {:.2f}s -> {:.2f}s ({:.2f}x)  RMSE {} -> {}{}".format(
+            result['surface'], result['points'], result['method'], result['precision'], old['wall'], result['wall'],
+            ratio, old['rmse'], result['rmse'], flag)
+    return regressions
+
+
+def countLines(filepath):
+    """
+    :param filepath:
+    :return: Number of lines in a file
+    """
+    count = 0
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def gitCommit():
+    """
+    :return: The commit we're benchmarking, if we can tell
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,6 @@ import numpy as np
 from pointcloud2raster.raster import Raster
 import os
 import math
-import csv
-import random
 import argparse
 # this allows GDAL to throw Python Exceptions
 
@@ -18,15 +16,28 @@ import argparse
 """
 
 
+# The cloud gets generated and written this many cells at a time so memory stays bounded no matter
+# how big a cloud we ask for
+CLOUD_BLOCK_CELLS = 256 * 1024
+
+# Every cell of the cloud gets between this many points (inclusive)
+CLOUD_MIN_POINTS = 3
+CLOUD_MAX_POINTS = 15
+
+# Lines formatted in one go when writing the cloud out. Bigger blocks get written in pieces this
+# size so the format string, the tuple of floats and the text stay small
+WRITE_LINES = 64 * 1024
+
 proj = 'PROJCS["NAD_1983_2011_StatePlane_Arizona_Central_FIPS_0202",GEOGCS["GCS_NAD_1983_2011",DATUM["NAD_1983_2011",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["false_easting",213360.0],PARAMETER["false_northing",0.0],PARAMETER["central_meridian",-111.9166666666667],PARAMETER["scale_factor",0.9999],PARAMETER["latitude_of_origin",31.0],UNIT["Meter",1.0]]'
 
-def array2rastercsv(array, outName, templateRaster, yoffset=0, xoffset=0, DataType=gdal.GDT_Float32):
+def array2rastercsv(array, outName, templateRaster, yoffset=0, xoffset=0, DataType=gdal.GDT_Float32, seed=0):
     """
 
     :param array: The array with data
     :param outName: The output name (no extension. Will be suffixed)
     :param templateRaster: Where to get metadata for the raster
     :param DataType:
+    :param seed: Seed for the cloud's random points so the same inputs always give the same cloud
     :return:
     """
     rastername = outName + ".tif"
@@ -59,27 +70,107 @@ def array2rastercsv(array, outName, templateRaster, yoffset=0, xoffset=0, DataTy
     # Now write a grid.
     np.savetxt(matrixname, newArr, fmt='%.3f', delimiter=",")
 
+    # Cell centers along each axis
+    centerX = np.arange(cols) * cw + originX + (cw / 2)
+    centerY = np.arange(rows) * ch + originY + (ch / 2)
+
     # Now save the same file as a CSV
     csvname = outName + ".csv"
     with open(csvname, 'wb') as csvfile:
-        spamwriter = csv.writer(csvfile, delimiter=' ', quoting=csv.QUOTE_NONE)
-        for idy, row in enumerate(newArr):
-            for idx, cell in enumerate(row):
-                left = idx * templateRaster.cellWidth + originX + (cw / 2)
-                top = idy * templateRaster.cellHeight + originY + (ch / 2)
-                spamwriter.writerow([left, top, cell])
-
-    # The cloud CSV has randomized tesselation
+        for first, last in _rowBlocks(rows, cols):
+            block = np.empty(((last - first) * cols, 3))
+            block[:, 0] = np.tile(centerX, last - first)
+            block[:, 1] = np.repeat(centerY[first:last], cols)
+            block[:, 2] = newArr[first:last].ravel()
+            _writeBlock(csvfile, block)
+
+    # The cloud CSV has randomized tesselation. We build it a block of rows at a time and
+    # write each block out in one go
+    rng = _randomGenerator(seed)
     csvname = outName + "_cloud.csv"
     with open(csvname, 'wb') as csvfile:
-        spamwriter = csv.writer(csvfile, delimiter=' ', quoting=csv.QUOTE_NONE)
-        for idy, row in enumerate(newArr):
-            for idx, cell in enumerate(row):
-                for pt in range(0, random.randint(3,15)):
-                    val = cell + random.uniform(-0.2,0.2)
-                    left = idx * templateRaster.cellWidth + originX + (cw / 2) + random.uniform( -cw / 2, cw / 2 )
-                    top = idy * templateRaster.cellHeight + originY + (ch / 2) + random.uniform( -ch / 2, ch / 2 )
-                    spamwriter.writerow([left, top, val])
+        for first, last in _rowBlocks(rows, cols):
+            counts = _randomIntegers(rng, CLOUD_MIN_POINTS, CLOUD_MAX_POINTS + 1, (last - first) * cols)
+            cells = np.repeat(np.arange(first * cols, last * cols), counts)
+            npts = len(cells)
+
+            block = np.empty((npts, 3))
+            block[:, 0] = centerX[cells % cols] + rng.uniform(-0.5, 0.5, npts) * cw
+            block[:, 1] = centerY[cells // cols] + rng.uniform(-0.5, 0.5, npts) * ch
+            block[:, 2] = newArr.ravel()[cells] + rng.uniform(-0.2, 0.2, npts)
+            _writeBlock(csvfile, block)
+
+
+def _rowBlocks(rows, cols):
+    """
+    Split the rows of an array into blocks of about CLOUD_BLOCK_CELLS cells
+    :param rows:
+    :param cols:
+    :return: generator of (first row, last row + 1)
+    """
+    blockRows = max(1, CLOUD_BLOCK_CELLS // max(1, cols))
+    for first in range(0, rows, blockRows):
+        yield first, min(first + blockRows, rows)
+
+
+def _writeBlock(csvfile, block):
+    """
+    Write an N x 3 block of X, Y, Z as space-delimited lines. Formatting WRITE_LINES lines at a
+    time is a lot quicker than going line by line and keeps the temporaries small.
+    :param csvfile:
+    :param block:
+    :return:
+    """
+    for start in range(0, len(block), WRITE_LINES):
+        piece = block[start:start + WRITE_LINES]
+        csvfile.write(("%.6f %.6f %.6f\n" * len(piece)) % tuple(piece.ravel()))
+
+
+def _randomGenerator(seed):
+    """
+    A seeded random generator. Newer numpy has np.random.Generator, older ones only have RandomState
+    :param seed:
+    :return:
+    """
+    default_rng = getattr(np.random, 'default_rng', None)
+    if default_rng is not None:
+        return default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def _randomIntegers(rng, low, high, size):
+    """
+    Random integers from low up to (not including) high with either kind of generator
+    :param rng:
+    :param low:
+    :param high:
+    :param size:
+    :return:
+    """
+    if hasattr(rng, 'integers'):
+        return rng.integers(low, high, size)
+    return rng.randint(low, high, size)
+
+
+def _indices(width, height):
+    """
+    Row and column numbers for every cell of a (width, height) array
+    :param width:
+    :param height:
+    :return: (idy, idx) arrays
+    """
+    return np.indices((width, height))
+
+
+def _sawtooth(index, period):
+    """
+    Where we are in each period of a sawtooth, from 0 up to 1
+    :param index: array of cell numbers
+    :param period: cells per tooth
+    :return:
+    """
+    # This used to be math.floor(1/2 + index/period) but 1/2 is 0 in Python 2 so it's a plain floor
+    return index / period - np.floor(index / period)
 
 
 def slopeyArray(width, height, high, low):
@@ -93,11 +184,8 @@ def slopeyArray(width, height, high, low):
     """
     high = float(high)
     low = float(low)
-    array = np.empty((width, height))
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            array[idy][idx] = high - (high - low) *  (float(idx)/(width-1))
-    return array
+    idy, idx = _indices(width, height)
+    return high - (high - low) * (idx / float(width - 1))
 
 
 
@@ -113,13 +201,9 @@ def checkerBoardArray(width, height, high, low):
     gridsize = 10
     high = float(high)
     low = float(low)
-    array = np.empty((width, height))
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            switch = bool((idx / gridsize) % 2) != bool((idy  / gridsize) % 2)
-            array[idy][idx] = high if switch else low
-
-    return array
+    idy, idx = _indices(width, height)
+    switch = ((idx // gridsize) % 2 == 1) != ((idy // gridsize) % 2 == 1)
+    return np.where(switch, high, low)
 
 def squareHillArray(width, height, high, low):
     """
@@ -132,14 +216,9 @@ def squareHillArray(width, height, high, low):
     """
     high = float(high)
     low = float(low)
-    array = np.empty((width, height))
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            val = low
-            if idx < float(width/3) or idx > float(width/3)*2:
-                val = high
-            array[idy][idx] = val
-    return array
+    idy, idx = _indices(width, height)
+    third = float(width // 3)
+    return np.where((idx < third) | (idx > third * 2), high, low)
 
 def sawtoothArray(width, height, high, low, phase = 0):
     """
@@ -155,12 +234,9 @@ def sawtoothArray(width, height, high, low, phase = 0):
     low = float(low)
     nWidth = width - 1
     nHeight = height - 1
-    array = np.empty((width, height))
+    idy, idx = _indices(width, height)
     period = float(width) / 4
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            array[idy][idx] = low +  (idx/period - math.floor(1/2 + idx/period)) * (high-low)
-    return array
+    return low + _sawtooth(idx, period) * (high - low)
 
 def doubleSawtoothArray(width, height, high, low, phase = 0):
     """
@@ -176,14 +252,11 @@ def doubleSawtoothArray(width, height, high, low, phase = 0):
     low = float(low)
     nWidth = width - 1
     nHeight = height - 1
-    array = np.empty((width, height))
+    idy, idx = _indices(width, height)
     period = float(width) / 4
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            vertical = low +  (idx/period - math.floor(1/2 + idx/period)) * (high-low)
-            horizontal = low + (idy/period - math.floor(1/2 + idy/period)) * (high-low)
-            array[idy][idx] = max([vertical, horizontal])
-    return array
+    vertical = low + _sawtooth(idx, period) * (high - low)
+    horizontal = low + _sawtooth(idy, period) * (high - low)
+    return np.maximum(vertical, horizontal)
 
 def sineArray(width, height, high, low, phase = 0):
     """
@@ -198,12 +271,9 @@ def sineArray(width, height, high, low, phase = 0):
     low = float(low)
     nWidth = width - 1
     nHeight = height - 1
-    array = np.empty((width, height))
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-            theta = (float(idx) / float(nWidth) * (math.pi * 2)) + phase
-            array[idy][idx] = (high-low)/2 + low + (math.sin(theta) * (high-low)/2)
-    return array
+    idy, idx = _indices(width, height)
+    theta = (idx / float(nWidth) * (math.pi * 2)) + phase
+    return (high-low)/2 + low + (np.sin(theta) * (high-low)/2)
 
 def tiltySlopeyArray(width, height, high, low, dir="N"):
     """
@@ -216,35 +286,25 @@ def tiltySlopeyArray(width, height, high, low, dir="N"):
     """
     high = float(high)
     low = float(low)
-    array = np.empty((width, height))
     nWidth = width - 1
     nHeight = height - 1
     diag =  math.sqrt(float(width)**2 + float(height)**2)
     diagAngle = math.atan2(float(width), float(height))
 
-    for idy, row in enumerate(array):
-        for idx, cell in enumerate(row):
-
-            val = np.nan
-            if dir == "N":
-                hypotenuse = math.sqrt(float(idx) ** 2 + float(idy) ** 2)
-                theta = diagAngle - math.atan2(idy, idx)
-                val = low + ((high - low) * hypotenuse * math.cos(theta) ) / diag
-            elif dir == "S":
-                hypotenuse = math.sqrt(float(idx) ** 2 + float(idy) ** 2)
-                theta = diagAngle - math.atan2(idy, idx)
-                val = high - ((high - low) * hypotenuse * math.cos(theta) ) / diag
-            elif dir == "E":
-                hypotenuse = math.sqrt(float(nWidth - idx) ** 2 + float(idy) ** 2)
-                theta = diagAngle - math.atan2(idy, (nWidth - idx))
-                val = low + ((high - low) * hypotenuse * math.cos(theta) ) / diag
-            elif dir == "W":
-                hypotenuse = math.sqrt(float(nWidth - idx) ** 2 + float(idy) ** 2)
-                theta = diagAngle - math.atan2(idy, (nWidth - idx))
-                val = high - ((high - low) * hypotenuse * math.cos(theta) ) / diag
-            array[idy][idx] = val
-
-    return array
+    idy, idx = _indices(width, height)
+    if dir in ["E", "W"]:
+        idx = nWidth - idx
+    idy = idy.astype(np.float64)
+    idx = idx.astype(np.float64)
+    hypotenuse = np.sqrt(idx ** 2 + idy ** 2)
+    theta = diagAngle - np.arctan2(idy, idx)
+    rise = ((high - low) * hypotenuse * np.cos(theta)) / diag
+
+    if dir in ["N", "E"]:
+        return low + rise
+    elif dir in ["S", "W"]:
+        return high - rise
+    return np.full((width, height), np.nan)
 
 def constArray(width,height,value):
     """
@@ -254,12 +314,10 @@ def constArray(width,height,value):
     :param value: constant value you want for this
     :return:
     """
-    arr = np.empty((width, height))
-    arr.fill(value)
-    return arr
+    return np.full((width, height), value, dtype=np.float64)
 
 def main():
-    templateRaster = Raster('data/template.tif')
+    templateRaster = Raster(filepath='data/template.tif')
 
     # Create rasters with the following parameters
     max = 980
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+from pointcloud2raster.grid import Grid
+from pointcloud2raster.interpolators import CreateInterpolator
+import numpy as np
+import unittest
+import math
+
+
+class CellIndexTest(unittest.TestCase):
+    """
+    Points on the right and bottom edges of the grid belong to the last column and row
+    """
+
+    def setUp(self):
+        # 4 x 4 cells of 1 with the top left corner at (0, 4)
+        self.grid = Grid(0.0, 4.0, 1.0, -1.0, 4, 4)
+
+    def test_edges_land_in_last_cell(self):
+        x = np.array([4.0, 0.5, 4.0, 0.0])
+        y = np.array([2.5, 0.0, 0.0, 4.0])
+        cells = self.grid.cellIndex(x, y)
+        self.assertEqual(cells.tolist(), [1 * 4 + 3, 3 * 4 + 0, 3 * 4 + 3, 0])
+
+    def test_edges_with_origin_offset(self):
+        origin = (1234567.891, 7654321.123)
+        x = np.array([4.0, 2.5]) - origin[0]
+        y = np.array([0.0, 4.0]) - origin[1]
+        cells = self.grid.cellIndex(x, y, origin)
+        self.assertEqual(cells.tolist(), [3 * 4 + 3, 0 * 4 + 2])
+
+    def test_outside_stays_outside(self):
+        x = np.array([4.5, -0.01, 1.0, 1.0])
+        y = np.array([1.0, 1.0, 4.01, -0.5])
+        self.assertEqual(self.grid.cellIndex(x, y).tolist(), [-1, -1, -1, -1])
+
+    def test_count_keeps_every_point(self):
+        # Integer coordinates and a cell size of 1 put plenty of points on the far edges
+        rng = np.random.RandomState(0)
+        points = rng.randint(0, 20, size=(500, 2)).astype(np.float64)
+        cw, ch = 1.0, -1.0
+        # Same extent GridRaster works out
+        top = math.ceil(points[:, 1].max() / abs(ch)) * abs(ch)
+        bottom = math.floor(points[:, 1].min() / abs(ch)) * abs(ch)
+        left = math.floor(points[:, 0].min() / cw) * cw
+        right = math.ceil(points[:, 0].max() / cw) * cw
+        grid = Grid.fromExtent(left, right, top, bottom, cw, ch)
+
+        origin = points.mean(axis=0)
+        counts = CreateInterpolator(points, np.ones(len(points)), origin, 'count').interpolate(grid, origin)
+        self.assertEqual(np.nansum(counts), len(points))
+        # With whole-number coordinates the last column is x == right - 1 plus everything on the edge
+        self.assertEqual(np.nansum(counts[:, -1]), ((points[:, 0] == right) | (points[:, 0] == right - 1)).sum())
+
+
+if __name__ == '__main__':
+    unittest.main()